@@ -0,0 +1,328 @@
+#!/usr/bin/env python
+
+# A columnar archive of drive snapshots, so what mdm learns about a drive outlives the program.
+#   The archive is a directory holding one file of fixed-width little-endian values per field (a column), with a
+#   row per snapshot appended in time order:
+#     <field>.col      Identity, counts and status of each snapshot (see COLUMNS).
+#     attr_NNN.col     Raw value of SMART attribute NNN (MISSING where a snapshot doesn't have it).
+#     history.dat      Test history text of every snapshot, located by the historyOffset/historyLength columns.
+#     models.txt       Model strings, one per line; the model column holds line numbers (dictionary encoding).
+#     serials.txt      Serial numbers, likewise.
+#     serial_last.col  Newest row of each serial number. With the previous column (the row of the same drive's
+#                      snapshot before) it forms the serial index: a drive's rows are found without any scan.
+#     meta.json        Committed row, dictionary and history sizes, and the attribute columns that exist.
+#   Rows are written past the committed end of each file and only become part of the archive when meta.json is
+#   replaced (by atomic rename), so an interrupted append leaves the archive as it was. Reading maps the columns
+#   into memory as NumPy arrays, so a query touches only the columns it uses and copies nothing. Writing doesn't
+#   need NumPy. One writer at a time is allowed (enforced with a lock file); any number of readers.
+import fcntl
+import json
+import os
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Needed for queries only.
+
+from Drive import *
+
+ARCHIVE_DIR = "/var/tmp/mdm/archive"
+META_FILE = "meta.json"
+LOCK_FILE = "lock"
+HISTORY_FILE = "history.dat"
+MODELS_FILE = "models.txt"
+SERIALS_FILE = "serials.txt"
+SERIAL_LAST_FILE = "serial_last.col"
+ATTRIBUTE_FILE = "attr_%03d.col"
+ATTRIBUTE_FORMAT = "q"
+MISSING = NOT_INITIALIZED  # Value of counts and attributes a snapshot doesn't have.
+
+# Columns of every snapshot: (name, struct format character).
+COLUMNS = [
+    ("time", "d"),  # Unix time of the snapshot.
+    ("serial", "i"),  # Line of serials.txt.
+    ("model", "i"),  # Line of models.txt.
+    ("previous", "q"),  # Row of the same drive's previous snapshot, or -1.
+    ("hours", "q"),
+    ("realloc", "q"),
+    ("pending", "q"),
+    ("uncorrectable", "q"),
+    ("statusCode", "i"),
+    ("state", "b"),
+    ("historyOffset", "q"),
+    ("historyLength", "i"),
+]
+COLUMN_FORMATS = dict(COLUMNS)
+
+
+# Snapshot values of a drive, by column name (apart from those the archive fills in).
+def snapshotValues(drive, timestamp):
+    return {"time": timestamp, "hours": drive.hours, "realloc": drive.reallocCount, "pending": drive.pendingCount,
+            "uncorrectable": drive.uncorrectableCount, "statusCode": drive.smartStatusCode, "state": drive.state}
+
+
+# What has to change about a drive for record() to take another snapshot of it.
+def snapshotKey(drive):
+    return (drive.hours, drive.reallocCount, drive.pendingCount, drive.uncorrectableCount, drive.smartStatusCode,
+            drive.state, tuple(drive.testHistory))
+
+
+# Whether a snapshot is worth archiving. A drive without a serial number can't be told apart from any other (they'd
+#   all share one serial index chain), and a timed-out or spun-down drive has nothing new to record.
+def isRecordable(drive):
+    return drive.smartCapable and drive.serial != "" and drive.state not in [DR_STATE_TIMEOUT, DR_STATE_STANDBY]
+
+
+class Archive(object):
+    def __init__(self, directory=ARCHIVE_DIR, writable=False):
+        self.directory = directory
+        self.writable = writable
+        self.lockFile = None
+        if writable:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.lockFile = open(self.path(LOCK_FILE), 'a')
+            fcntl.flock(self.lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)  # IOError if another writer has it.
+        self.recordedKeys = dict()  # Snapshot key of each drive recorded this session, by device path.
+        self.load()
+
+    # Read the committed state of the archive (also used to drop whatever a failed append left in memory).
+    def load(self):
+        self.meta = {"rows": 0, "models": 0, "serials": 0, "historySize": 0, "attributes": []}
+        if os.path.exists(self.path(META_FILE)):
+            with open(self.path(META_FILE)) as metaFile:
+                self.meta = json.load(metaFile)
+        self.models = self.readDictionary(MODELS_FILE, self.meta["models"])
+        self.serials = self.readDictionary(SERIALS_FILE, self.meta["serials"])
+        self.modelCodes = dict((model, code) for code, model in enumerate(self.models))
+        self.serialCodes = dict((serial, code) for code, serial in enumerate(self.serials))
+        self.views = dict()  # Memory-mapped columns, by file name.
+        if self.writable:
+            self.repairSerialIndex()
+
+    def path(self, fileName):
+        return os.path.join(self.directory, fileName)
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    # Read the committed lines of a dictionary file, dropping any an interrupted append left after them.
+    def readDictionary(self, fileName, count):
+        if not os.path.exists(self.path(fileName)):
+            return list()
+        with open(self.path(fileName)) as dictionaryFile:
+            lines = dictionaryFile.read().split('\n')
+        if self.writable and len(lines) - 1 != count:
+            with open(self.path(fileName), 'w') as dictionaryFile:
+                dictionaryFile.write(''.join(line + '\n' for line in lines[:count]))
+        return lines[:count]
+
+    # Make sure the serial index only points at committed rows (a write may have been interrupted after updating
+    #   it); rebuild it from the serial column if not.
+    def repairSerialIndex(self):
+        lastRows = self.readValues(SERIAL_LAST_FILE, "q", self.meta["serials"])
+        if len(lastRows) == self.meta["serials"] and all(row < self.meta["rows"] for row in lastRows):
+            return
+        lastRows = [-1] * self.meta["serials"]
+        for row, code in enumerate(self.readValues("serial.col", "i", self.meta["rows"])):
+            lastRows[code] = row
+        self.writeValues(SERIAL_LAST_FILE, "q", 0, lastRows)
+
+    # Read the first count values of a column file (fewer if it's shorter).
+    def readValues(self, fileName, formatChar, count):
+        if not os.path.exists(self.path(fileName)):
+            return list()
+        size = struct.calcsize("<" + formatChar)
+        with open(self.path(fileName), 'rb') as columnFile:
+            data = columnFile.read(count * size)
+        return list(struct.unpack("<%d%s" % (len(data) // size, formatChar), data))
+
+    # Read one value of a column file.
+    def readValue(self, fileName, formatChar, row):
+        size = struct.calcsize("<" + formatChar)
+        with open(self.path(fileName), 'rb') as columnFile:
+            columnFile.seek(row * size)
+            return struct.unpack("<" + formatChar, columnFile.read(size))[0]
+
+    # Write values into a column file starting at a given row.
+    def writeValues(self, fileName, formatChar, row, values):
+        mode = 'r+b' if os.path.exists(self.path(fileName)) else 'w+b'
+        with open(self.path(fileName), mode) as columnFile:
+            columnFile.seek(row * struct.calcsize("<" + formatChar))
+            columnFile.write(struct.pack("<%d%s" % (len(values), formatChar), *values))
+
+    # Code of a string in a dictionary, adding it (to be written at commit) if it's new.
+    def encode(self, text, strings, codes, newStrings):
+        text = text.replace('\n', ' ')
+        if text not in codes:
+            codes[text] = len(strings)
+            strings.append(text)
+            newStrings.append(text)
+        return codes[text]
+
+    # Append snapshots of a list of drives (or their DriveSnapshots), taken at the given Unix times (default now),
+    #   and commit them.
+    def append(self, drives, timestamps=None):
+        if len(drives) == 0:
+            return
+        timestamps = timestamps if timestamps is not None else [time.time()] * len(drives)
+        firstRow = self.meta["rows"]
+        newModels, newSerials = list(), list()
+        lastRows = dict()  # Updated serial index entries, by serial code.
+        columns = dict((name, list()) for name, _ in COLUMNS)
+        history = list()
+        historySize = self.meta["historySize"]
+        for i, drive in enumerate(drives):
+            values = snapshotValues(drive, timestamps[i])
+            serialCode = self.encode(drive.serial, self.serials, self.serialCodes, newSerials)
+            values["serial"] = serialCode
+            values["model"] = self.encode(drive.model, self.models, self.modelCodes, newModels)
+            values["previous"] = lastRows.get(serialCode, self.lastRow(serialCode))
+            lastRows[serialCode] = firstRow + i
+            historyText = '\n'.join(drive.testHistory)
+            values["historyOffset"] = historySize
+            values["historyLength"] = len(historyText)
+            history.append(historyText)
+            historySize += len(historyText)
+            for name, _ in COLUMNS:
+                columns[name].append(values[name])
+
+        # Write the rows past the committed end of every column, starting any new attribute columns.
+        for name, formatChar in COLUMNS:
+            self.writeValues(name + ".col", formatChar, firstRow, columns[name])
+        seenIds = set(attribute.idNumber for drive in drives for attribute in drive.attributes if attribute)
+        attributeIds = sorted(set(self.meta["attributes"]) | seenIds)
+        for idNumber in attributeIds:
+            if idNumber not in self.meta["attributes"]:
+                self.writeValues(ATTRIBUTE_FILE % idNumber, ATTRIBUTE_FORMAT, 0, [MISSING] * firstRow)
+            values = list()
+            for drive in drives:
+                value = firstNumber(drive.attributes[idNumber].rawValue) if drive.attributes[idNumber] else None
+                values.append(value if value is not None else MISSING)
+            self.writeValues(ATTRIBUTE_FILE % idNumber, ATTRIBUTE_FORMAT, firstRow, values)
+        with open(self.path(HISTORY_FILE), 'r+b' if os.path.exists(self.path(HISTORY_FILE)) else 'w+b') as heap:
+            heap.seek(self.meta["historySize"])
+            heap.write(''.join(history))
+        for fileName, newStrings in [(MODELS_FILE, newModels), (SERIALS_FILE, newSerials)]:
+            with open(self.path(fileName), 'a') as dictionaryFile:
+                dictionaryFile.write(''.join(text + '\n' for text in newStrings))
+        for serialCode, row in lastRows.items():
+            self.writeValues(SERIAL_LAST_FILE, "q", serialCode, [row])
+
+        # Commit.
+        self.meta = {"rows": firstRow + len(drives), "models": len(self.models), "serials": len(self.serials),
+                     "historySize": historySize, "attributes": attributeIds}
+        temporaryPath = self.path(META_FILE + ".tmp")
+        with open(temporaryPath, 'w') as metaFile:
+            json.dump(self.meta, metaFile)
+            metaFile.flush()
+            os.fsync(metaFile.fileno())
+        os.rename(temporaryPath, self.path(META_FILE))
+        self.views = dict()  # Mappings of the old size are stale.
+
+    # Append snapshots of the drives that changed since they were last recorded this session.
+    def record(self, drives):
+        changed, changedPaths = list(), list()
+        for drive in drives:
+            snapshot = drive.snapshot  # Read each drive once, so its values are consistent.
+            if not isRecordable(snapshot):
+                continue
+            key = snapshotKey(snapshot)
+            if self.recordedKeys.get(drive.devicePath) != key:
+                self.recordedKeys[drive.devicePath] = key
+                changed.append(snapshot)
+                changedPaths.append(drive.devicePath)
+        try:
+            self.append(changed)
+        except (IOError, OSError):
+            # A full or failing disk mustn't stop the program; the snapshots are retried after the next query.
+            self.load()
+            for devicePath in changedPaths:
+                del self.recordedKeys[devicePath]
+            return 0
+        return len(changed)
+
+    # Newest committed row of a serial code, or -1.
+    def lastRow(self, serialCode):
+        if serialCode >= self.meta["serials"]:
+            return -1
+        return self.readValue(SERIAL_LAST_FILE, "q", serialCode)
+
+    # Rows of a drive's snapshots, newest first, found by following the serial index.
+    def rowsForSerial(self, serial):
+        rows = list()
+        if serial in self.serialCodes:
+            row = self.lastRow(self.serialCodes[serial])
+            while row >= 0:
+                rows.append(row)
+                row = self.value("previous", row)
+        return rows
+
+    # One value of a column.
+    def value(self, name, row):
+        return self.readValue(name + ".col", COLUMN_FORMATS[name], row)
+
+    # Test history of a snapshot.
+    def history(self, row):
+        with open(self.path(HISTORY_FILE), 'rb') as heap:
+            heap.seek(self.value("historyOffset", row))
+            text = heap.read(self.value("historyLength", row))
+        return text.split('\n') if text else []
+
+    # A column as a read-only memory-mapped NumPy array (nothing is read until it's used).
+    def column(self, name):
+        return self.mapped(name + ".col", COLUMN_FORMATS[name])
+
+    # Raw values of an attribute as a memory-mapped NumPy array (all MISSING if no snapshot has it).
+    def attribute(self, idNumber):
+        if idNumber not in self.meta["attributes"]:
+            return numpy.full(len(self), MISSING, numpy.int64)
+        return self.mapped(ATTRIBUTE_FILE % idNumber, ATTRIBUTE_FORMAT)
+
+    def mapped(self, fileName, formatChar):
+        if fileName not in self.views:
+            dtype = numpy.dtype("<" + formatChar)
+            if len(self) == 0:
+                self.views[fileName] = numpy.zeros(0, dtype)
+            else:
+                self.views[fileName] = numpy.memmap(self.path(fileName), dtype, 'r', shape=(len(self),))
+        return self.views[fileName]
+
+    # Drives (of a model, if given) whose attribute raw value is higher in their newest snapshot than in their
+    #   oldest. Returns (serial, model, oldest value, newest value) tuples.
+    def attributeGrowth(self, idNumber, model=None):
+        rows = numpy.arange(len(self))
+        if model is not None:
+            if model not in self.modelCodes:
+                return []
+            rows = numpy.flatnonzero(self.column("model") == self.modelCodes[model])
+        values = self.attribute(idNumber)[rows]
+        known = values != MISSING
+        rows, values = rows[known], values[known]
+        serials = self.column("serial")[rows]
+
+        # Sort by serial (rows are already in time order) and compare the first and last value of each serial.
+        order = numpy.lexsort((rows, serials))
+        serials, values, rows = serials[order], values[order], rows[order]
+        starts = numpy.flatnonzero(numpy.append(True, serials[1:] != serials[:-1]))
+        ends = numpy.append(starts[1:], len(serials)) - 1
+        grew = numpy.flatnonzero(values[ends] > values[starts])
+        models = self.column("model")
+        return [(self.serials[serials[starts[i]]], self.models[models[rows[ends[i]]]], values[starts[i]],
+                 values[ends[i]]) for i in grew]
+
+    def close(self):
+        self.views = dict()
+        if self.lockFile is not None:
+            self.lockFile.close()
+            self.lockFile = None
+
+
+# Open the default archive for writing, or return None if it can't be (eg, another mdm is writing it).
+def openArchive(directory=ARCHIVE_DIR):
+    try:
+        return Archive(directory, writable=True)
+    except (IOError, OSError):
+        return None
@@ -2,7 +2,11 @@
 import re
 
 
+# One line of the attribute table. Attributes are never changed once built, so drive snapshots share them.
 class Attribute(object):
+    __slots__ = ("smartctlLine", "idNumber", "name", "flag", "value", "worst", "threshold", "type", "updated",
+                 "whenFailed", "rawValue", "hasWhenFailed")
+
     def __init__(self, smartctlLine):
         self.smartctlLine = smartctlLine
 
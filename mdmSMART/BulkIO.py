@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+
+# Bandwidth-heavy whole-device operations (wiping, verifying and imaging) for MDM. These are run by the mdmio
+#   helper in a child process so the mdm interface stays responsive; progress is reported through a small status
+#   file.
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import io
+import os
+import stat
+import struct
+import threading
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Zero blocks are then found by plain comparison, which is slower.
+
+DEFAULT_BLOCK_SIZE = 1024 * 1024  # Bytes per read or write.
+PROGRESS_INTERVAL_SECS = 1.0  # Minimum time between progress file updates.
+
+# Outcomes of a bulk operation (also used as the exit code of mdmio).
+BULK_PASSED, BULK_FAILED, BULK_ERROR = range(3)
+
+# Discarding (TRIM) the whole of a solid-state drive instead of overwriting it. Block devices are discarded with
+#   the ioctls below; an image file stands in for an SSD by having holes punched in it.
+BLKDISCARD = 0x1277  # _IO(0x12, 119), argument: uint64 start and length in bytes.
+BLKSECDISCARD = 0x127D  # _IO(0x12, 125), as BLKDISCARD but also erases any copies the drive made of the data.
+FALLOC_FL_KEEP_SIZE, FALLOC_FL_PUNCH_HOLE = 0x01, 0x02
+DISCARD_BATCH_BYTES = 1 << 30  # Bytes discarded per request.
+DISCARD_SAMPLE_BYTES = 64 * 1024  # Bytes read back at the start, middle and end of each discarded batch.
+DISCARD_UNSUPPORTED = [errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS]  # Errors meaning "can't discard".
+
+# Imaging a device to a sparse file.
+IMAGE_BLOCK_SIZE = 4 * 1024 * 1024  # Bytes read at a time (into one reused buffer).
+HOLE_SIZE = 4096  # Granularity of zero detection: all-zero runs of this size are left as holes in the image.
+SECTOR_SIZE = 512  # Unit in which unreadable blocks are retried.
+IMAGE_MAP_HEADER = "# mdm image map"
+
+
+# Size of a block device or file in bytes.
+def deviceSize(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return os.lseek(fd, 0, os.SEEK_END)
+    finally:
+        os.close(fd)
+
+
+# Test whether anything holds a block device: a filesystem mounted on it or on one of its partitions, device-mapper
+#   (LVM), md RAID or swap. The kernel refuses an exclusive (O_EXCL) open of a held device with EBUSY; any other
+#   failure also counts as in use, since the device can't be shown to be free. A missing device is left for the
+#   operation itself to report. Files (eg, an image standing in for a drive) are never held.
+def isInUse(devicePath):
+    try:
+        if not stat.S_ISBLK(os.stat(devicePath).st_mode):
+            return False
+        os.close(os.open(devicePath, os.O_WRONLY | os.O_EXCL))
+    except OSError as error:
+        return error.errno != errno.ENOENT
+    return False
+
+
+# Atomically record progress as "<bytes done> <bytes total>" so a reader never sees a half-written file.
+def writeProgress(progressPath, bytesDone, bytesTotal):
+    if progressPath is None:
+        return
+    temporaryPath = progressPath + ".tmp"
+    with open(temporaryPath, 'w') as progressFile:
+        progressFile.write(str(bytesDone) + " " + str(bytesTotal) + "\n")
+    os.rename(temporaryPath, progressPath)
+
+
+# Read a progress file as (bytesDone, bytesTotal), or None if there isn't one yet.
+def readProgress(progressPath):
+    try:
+        with open(progressPath) as progressFile:
+            bytesDone, bytesTotal = progressFile.read().split()
+        return int(bytesDone), int(bytesTotal)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+# Transfer the blocks of part of a device with several requests in flight. Each of depth threads has its own file
+#   descriptor (so they never share a file position) and handles every depth-th block, calling
+#   transferBlock(fd, count) with the descriptor positioned at the block; transferBlock returns False to stop
+#   everything (eg, on finding non-zero data). Transfers stop early at the deadline if one is given. Returns
+#   (passed, bytes done).
+def stripedTransfer(path, flags, blockSize, depth, transferBlock, progressPath=None, throttle=None, start=0,
+                    end=None, deadline=None):
+    bytesTotal = deviceSize(path)
+    end = bytesTotal if end is None else min(end, bytesTotal)
+    lock = threading.Lock()
+    shared = {"done": 0, "stop": False, "passed": True, "error": None}
+
+    def worker(index):
+        try:
+            fd = os.open(path, flags)
+        except (IOError, OSError) as error:
+            shared["error"], shared["stop"] = error, True
+            return
+        try:
+            offset = start + index * blockSize
+            while offset < end and not shared["stop"]:
+                if deadline is not None and time.time() > deadline:
+                    break
+                count = min(blockSize, end - offset)
+                if throttle is not None:
+                    throttle.wait(count)
+                os.lseek(fd, offset, os.SEEK_SET)
+                if not transferBlock(fd, count):
+                    shared["passed"], shared["stop"] = False, True
+                with lock:
+                    shared["done"] += count
+                offset += depth * blockSize
+            if flags & (os.O_WRONLY | os.O_RDWR):
+                os.fsync(fd)
+        except (IOError, OSError) as error:
+            shared["error"], shared["stop"] = error, True
+        finally:
+            os.close(fd)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(depth)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(PROGRESS_INTERVAL_SECS)
+            writeProgress(progressPath, shared["done"], end - start)
+    if shared["error"] is not None:
+        raise shared["error"]
+    return shared["passed"], shared["done"]
+
+
+# Write zeros over a block (see stripedTransfer).
+def zeroBlockWriter(blockSize):
+    zeroBlock = '\0' * blockSize
+
+    def writeBlock(fd, count):
+        while count > 0:
+            count -= os.write(fd, zeroBlock if count == blockSize else zeroBlock[:count])
+        return True
+    return writeBlock
+
+
+# Read a block and check that it's all zeros (see stripedTransfer).
+def zeroBlockChecker(blockSize):
+    zeroBlock = '\0' * blockSize
+
+    def checkBlock(fd, count):
+        block = os.read(fd, count)
+        return len(block) == count and block == zeroBlock[:count]  # A short read means the device ended early.
+    return checkBlock
+
+
+# Free a range of an image file, which then reads back as zeros (like a discarded range of an SSD).
+def punchHole(fd, offset, length):
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    fallocate = getattr(libc, "fallocate64", None) or libc.fallocate
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    if fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length) != 0:
+        code = ctypes.get_errno()
+        raise OSError(code, os.strerror(code))
+
+
+# Test whether a device (or image file) might support discard. Only a block device whose queue says it can't
+#   discard is ruled out; anything else has to be tried.
+def mightDiscard(path):
+    name = os.path.basename(os.path.realpath(path))
+    try:
+        with open("/sys/block/" + name + "/queue/discard_max_bytes") as maxFile:
+            return int(maxFile.read()) > 0
+    except (IOError, ValueError):
+        return True
+
+
+# Discard a whole device in batches, reading back samples of each batch to check that it now reads as zeros.
+#   Secure discard is used if asked for and the device supports it, otherwise plain discard. Returns True if the
+#   device was discarded and reads as zeros, or False if it can't discard or doesn't read back zeros afterwards
+#   (so it has to be overwritten instead).
+def discardDevice(path, progressPath=None, secure=False, batchBytes=DISCARD_BATCH_BYTES):
+    if not mightDiscard(path):
+        return False
+    bytesTotal = deviceSize(path)
+    zeroBlock = '\0' * DISCARD_SAMPLE_BYTES
+    fd = os.open(path, os.O_RDWR)
+    try:
+        isBlockDevice = stat.S_ISBLK(os.fstat(fd).st_mode)
+        requests = [BLKSECDISCARD, BLKDISCARD] if secure else [BLKDISCARD]
+        offset = 0
+        while offset < bytesTotal:
+            length = min(batchBytes, bytesTotal - offset)
+            try:
+                if isBlockDevice:
+                    fcntl.ioctl(fd, requests[0], struct.pack("=QQ", offset, length))
+                else:
+                    punchHole(fd, offset, length)
+            except (IOError, OSError) as error:
+                if error.errno not in DISCARD_UNSUPPORTED:
+                    raise
+                if offset > 0 or len(requests) == 1:
+                    return False
+                requests.pop(0)  # No secure discard; try again with plain discard.
+                continue
+
+            # Check the start, middle and end of the batch.
+            for sampleOffset in [offset, offset + length // 2, offset + length - DISCARD_SAMPLE_BYTES]:
+                sampleOffset = max(offset, sampleOffset)
+                count = min(DISCARD_SAMPLE_BYTES, offset + length - sampleOffset)
+                os.lseek(fd, sampleOffset, os.SEEK_SET)
+                if os.read(fd, count) != zeroBlock[:count]:
+                    return False
+            offset += length
+            writeProgress(progressPath, offset, bytesTotal)
+    finally:
+        os.close(fd)
+    return True
+
+
+# Overwrite a whole device with zeros. If discard is set (for solid-state drives), the device is discarded instead
+#   where it supports that and reads back zeros afterwards.
+def wipeDevice(path, blockSize=DEFAULT_BLOCK_SIZE, progressPath=None, depth=1, throttle=None, discard=False,
+               secure=False):
+    if discard and discardDevice(path, progressPath, secure):
+        return BULK_PASSED
+    passed, bytesDone = stripedTransfer(path, os.O_WRONLY, blockSize, depth, zeroBlockWriter(blockSize),
+                                        progressPath, throttle)
+    writeProgress(progressPath, bytesDone, bytesDone)
+    return BULK_PASSED if passed else BULK_FAILED
+
+
+# Read back a whole device and check that every byte is zero.
+def verifyZeroed(path, blockSize=DEFAULT_BLOCK_SIZE, progressPath=None, depth=1, throttle=None):
+    passed, bytesDone = stripedTransfer(path, os.O_RDONLY, blockSize, depth, zeroBlockChecker(blockSize),
+                                        progressPath, throttle)
+    if passed:
+        writeProgress(progressPath, bytesDone, bytesDone)
+    return BULK_PASSED if passed else BULK_FAILED
+
+
+# Byte ranges [start, end) of the non-zero parts of the first count bytes of a buffer (a bytearray), found to
+#   HOLE_SIZE granularity. Whole granules are checked by vectorized comparison where NumPy is available.
+def nonZeroRuns(buffer, count):
+    whole = count // HOLE_SIZE
+    runs = list()
+    if numpy is not None:
+        granules = numpy.frombuffer(buffer, numpy.uint64, whole * HOLE_SIZE // 8).reshape(whole, HOLE_SIZE // 8)
+        nonZero = numpy.concatenate([[False], granules.any(axis=1), [False]])
+        edges = (numpy.flatnonzero(nonZero[1:] != nonZero[:-1]) * HOLE_SIZE).tolist()
+        runs = [[edges[i], edges[i + 1]] for i in range(0, len(edges), 2)]
+    else:
+        zeroGranule = '\0' * HOLE_SIZE
+        for start in range(0, whole * HOLE_SIZE, HOLE_SIZE):
+            if buffer[start:start + HOLE_SIZE] != zeroGranule:
+                if runs and runs[-1][1] == start:
+                    runs[-1][1] = start + HOLE_SIZE
+                else:
+                    runs.append([start, start + HOLE_SIZE])
+    tailStart = whole * HOLE_SIZE
+    if count > tailStart and buffer[tailStart:count] != '\0' * (count - tailStart):
+        if runs and runs[-1][1] == tailStart:
+            runs[-1][1] = count
+        else:
+            runs.append([tailStart, count])
+    return runs
+
+
+# Write the non-zero parts of a buffer to a file at an offset, skipping zero runs (which stay holes).
+def writeNonZero(fd, buffer, count, offset):
+    view = memoryview(buffer)
+    for start, end in nonZeroRuns(buffer, count):
+        os.lseek(fd, offset + start, os.SEEK_SET)
+        while start < end:
+            start += os.write(fd, view[start:end])
+
+
+# Read an image map as (bytes copied so far, list of unreadable (start, length) ranges). A missing map, or one
+#   made for a device of another size, means starting from the beginning.
+def readImageMap(mapPath, bytesTotal):
+    try:
+        with open(mapPath) as mapFile:
+            lines = mapFile.read().split('\n')
+        if lines[0] != IMAGE_MAP_HEADER + " " + str(bytesTotal):
+            return 0, list()
+        position = int(lines[1].split()[1])
+        badRanges = [tuple(int(number) for number in line.split()[1:]) for line in lines[2:] if line]
+        return position, badRanges
+    except (IOError, OSError, ValueError, IndexError):
+        return 0, list()
+
+
+# Atomically record how far imaging has got: a header line with the device size, "position <bytes copied>" and a
+#   "bad <start> <length>" line per unreadable range.
+def writeImageMap(mapPath, bytesTotal, position, badRanges):
+    lines = [IMAGE_MAP_HEADER + " " + str(bytesTotal), "position " + str(position)]
+    lines.extend("bad %d %d" % badRange for badRange in badRanges)
+    temporaryPath = mapPath + ".tmp"
+    with open(temporaryPath, 'w') as mapFile:
+        mapFile.write('\n'.join(lines) + '\n')
+    os.rename(temporaryPath, mapPath)
+
+
+# Read part of a device into a buffer, returning the number of bytes read before the first unreadable sector (a
+#   read that runs into a bad sector usually comes up short rather than failing; 0 if none could be read). Only a
+#   device that has really ended early is an error.
+def readInto(source, buffer, offset, count):
+    source.seek(offset)
+    try:
+        readCount = source.readinto(memoryview(buffer)[:count])
+    except IOError as error:
+        if error.errno != errno.EIO:
+            raise
+        readCount = 0
+    if readCount < count and os.lseek(source.fileno(), 0, os.SEEK_END) < offset + count:
+        raise IOError(errno.EIO, "device ended early")
+    return readCount
+
+
+# Add an unreadable (start, length) range to a list, merging it with the last one if they meet.
+def addBadRange(badRanges, start, length):
+    if badRanges and sum(badRanges[-1]) == start:
+        badRanges[-1] = (badRanges[-1][0], badRanges[-1][1] + length)
+    else:
+        badRanges.append((start, length))
+
+
+# Copy a whole device to a sparse image file, leaving all-zero parts of it as holes. Parts of blocks that can't be
+#   read are skipped, then retried a sector at a time at the end. Progress goes into a map file (default: the image path
+#   plus ".map"), so an interrupted run picks up where it stopped, and a rerun retries any unreadable sectors.
+#   Returns BULK_PASSED, or BULK_FAILED if some sectors couldn't be read (they're zeros in the image).
+def imageDevice(sourcePath, imagePath, blockSize=IMAGE_BLOCK_SIZE, progressPath=None, mapPath=None, throttle=None):
+    mapPath = mapPath or imagePath + ".map"
+    bytesTotal = deviceSize(sourcePath)
+    position, badRanges = readImageMap(mapPath, bytesTotal)
+    buffer = bytearray(blockSize)  # Reused for every read.
+    source = io.FileIO(sourcePath, 'r')
+    imageFd = os.open(imagePath, os.O_WRONLY | os.O_CREAT, 0o600)
+    try:
+        # Anything past the recorded position may be half written: cut it off, leaving holes up to the full size.
+        os.ftruncate(imageFd, position)
+        os.ftruncate(imageFd, bytesTotal)
+        lastReport = 0
+        while position < bytesTotal:
+            count = min(blockSize, bytesTotal - position)
+            if throttle is not None:
+                throttle.wait(count)
+            readCount = readInto(source, buffer, position, count)
+            writeNonZero(imageFd, buffer, readCount, position)
+            if readCount < count:
+                addBadRange(badRanges, position + readCount, count - readCount)
+            position += count
+            if time.time() - lastReport > PROGRESS_INTERVAL_SECS or position == bytesTotal:
+                os.fsync(imageFd)  # The map must never claim more than is safely in the image.
+                writeImageMap(mapPath, bytesTotal, position, badRanges)
+                writeProgress(progressPath, position, bytesTotal)
+                lastReport = time.time()
+
+        # Retry unreadable ranges a sector at a time, keeping only the sectors that still fail.
+        stillBad = list()
+        for start, length in badRanges:
+            for offset in range(start, start + length, SECTOR_SIZE):
+                count = min(SECTOR_SIZE, start + length - offset)
+                readCount = readInto(source, buffer, offset, count)
+                writeNonZero(imageFd, buffer, readCount, offset)
+                if readCount < count:
+                    addBadRange(stillBad, offset + readCount, count - readCount)
+        os.fsync(imageFd)
+        writeImageMap(mapPath, bytesTotal, position, stillBad)
+    finally:
+        os.close(imageFd)
+        source.close()
+    return BULK_FAILED if stillBad else BULK_PASSED
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+
+# Two-process mode for mdm: a collector process owns the Drive objects, smartctl queries and batch jobs, and
+#   publishes a fixed-layout record per drive into a SharedTable. The interface process reads the records without
+#   locking and sends commands back over a pipe, one line per command. A slow parse, a blocking test command or a
+#   burst of queries in the collector never delays drawing or key handling, and the collector can use another core.
+#   On the interface side, RemoteDrive and RemoteJobScheduler stand in for Drive and JobScheduler so the main loop
+#   works the same in both modes.
+import errno
+import os
+import re
+import select
+import time
+import traceback
+
+from Drive import *
+from Pipeline import *
+from Poller import DrivePoller
+from SharedTable import SharedTable
+from Archive import openArchive
+
+# Layout of a drive record: state, flags, realloc count, hours, SMART status code, then fixed-width strings for
+#   path, rotation rate, capacity, model, serial, G-sense count, status, ETA and status description, then the
+#   detail pane text (attribute and test history lines).
+DETAIL_SIZE = 4096
+RECORD_FORMAT = "=BBiii32s16s16s48s32s16s32s16s160s%ds" % DETAIL_SIZE
+
+# Bits of a record's flags field.
+FLAG_SMART_CAPABLE = 1
+FLAG_UNKNOWN_USB_BRIDGE = 2
+FLAG_FAILURE_HISTORY = 4
+FLAG_FAILED_ATTRIBUTES = 8
+FLAG_JOB_ACTIVE = 16
+
+# Prefixes of the detail lines of a record.
+DETAIL_ATTRIBUTE, DETAIL_FAILED_ATTRIBUTE, DETAIL_HISTORY_HEADER, DETAIL_HISTORY = "A", "W", "H", "T"
+DETAIL_COVERAGE = "S"
+
+# Pipelines that can be started by command, by name.
+PIPELINES = {"test-then-wipe": PIPELINE_TEST_THEN_WIPE, "wipe": PIPELINE_WIPE, "image": PIPELINE_IMAGE,
+             "span-test": PIPELINE_SPAN_TEST}
+
+PUBLISH_INTERVAL_SECS = 1.0  # Time between republishing every drive (ETAs count down on their own).
+READ_SIZE = 65536
+
+
+# Pack the parts of a drive the interface shows into record values, all from one snapshot of the drive.
+def packRecord(drive, job):
+    snapshot = drive.snapshot
+    flags = 0
+    if snapshot.smartCapable:
+        flags |= FLAG_SMART_CAPABLE
+    if snapshot.unknownUSBBridge:
+        flags |= FLAG_UNKNOWN_USB_BRIDGE
+    if snapshot.hasFailureHistory():
+        flags |= FLAG_FAILURE_HISTORY
+    if snapshot.hasFailedAttributes():
+        flags |= FLAG_FAILED_ATTRIBUTES
+    if job is not None and not job.isFinished():
+        flags |= FLAG_JOB_ACTIVE
+
+    detailLines = list()
+    coverage = drive.spanCoverage()
+    if coverage:
+        detailLines.append(DETAIL_COVERAGE + coverage)
+    for attribute in snapshot.importantAttributes:
+        prefix = DETAIL_FAILED_ATTRIBUTE if attribute.hasWhenFailed else DETAIL_ATTRIBUTE
+        detailLines.append(prefix + attribute.smartctlLine)
+    if len(snapshot.testHistory) > 0:
+        detailLines.append(DETAIL_HISTORY_HEADER + snapshot.testHistoryHeader)
+        detailLines.extend([DETAIL_HISTORY + testResult for testResult in snapshot.testHistory])
+    detail = '\n'.join(detailLines)
+    # Drop lines that don't fit whole, or cut a first line that doesn't fit on its own.
+    if len(detail) > DETAIL_SIZE:
+        end = detail.rfind('\n', 0, DETAIL_SIZE)
+        detail = detail[:end if end >= 0 else DETAIL_SIZE]
+
+    status = job.statusString() if job is not None else snapshot.statusString()
+    eta = (job.timeRemaining() if job is not None else "") or snapshot.testTimeRemaining()
+    return (snapshot.state, flags, snapshot.reallocCount, snapshot.hours, snapshot.smartStatusCode, drive.devicePath,
+            snapshot.rotationRate, snapshot.capacity, snapshot.model, snapshot.serial, str(snapshot.GSenseCount),
+            status, eta, snapshot.smartStatusDescription, detail)
+
+
+# Runs in the collector process: owns the drives, carries out commands and publishes drive records.
+class Collector(object):
+    def __init__(self, devicePaths, table, commandFd):
+        self.table = table
+        self.commandFd = commandFd
+        self.pendingText = ""  # Start of a command line that hasn't fully arrived yet.
+        self.drives = [Drive(devicePath) for devicePath in devicePaths]
+        self.driveIndex = dict((drive.devicePath, i) for i, drive in enumerate(self.drives))
+        self.jobScheduler = JobScheduler()
+        self.poller = DrivePoller(self.drives, self.jobScheduler)
+        self.archive = openArchive()  # Keeps snapshots of what the queries find.
+        self.running = True
+
+    def run(self):
+        lastPublish = 0
+        self.publish(range(len(self.drives)))
+        while self.running:
+            changed = self.readCommands(self.poller.waitSecs())
+
+            # Finish queries that are done, reap child processes and advance any batch jobs.
+            queriedDrives, jobsChanged = self.poller.step()
+            changed.update(self.driveIndex[drive.devicePath] for drive in queriedDrives)
+            if self.archive is not None:
+                self.archive.record([self.drives[i] for i in changed if self.drives[i].state != DR_STATE_QUERYING])
+            if jobsChanged:
+                changed.update(range(len(self.drives)))
+
+            if time.time() - lastPublish > PUBLISH_INTERVAL_SECS:
+                changed.update(range(len(self.drives)))
+                lastPublish = time.time()
+            self.publish(changed)
+
+    def publish(self, indexes):
+        for i in indexes:
+            drive = self.drives[i]
+            self.table.write(i, packRecord(drive, self.jobScheduler.jobFor(drive)))
+
+    # Wait up to timeoutSecs for commands and carry out any that arrive. Returns the indexes of affected drives.
+    def readCommands(self, timeoutSecs):
+        changed = set()
+        readable, _, _ = select.select([self.commandFd], [], [], timeoutSecs)
+        if len(readable) == 0:
+            return changed
+        text = os.read(self.commandFd, READ_SIZE)
+        if text == "":
+            self.running = False  # The interface has gone away.
+            return changed
+        lines = (self.pendingText + text).split('\n')
+        self.pendingText = lines.pop()
+        for line in lines:
+            changed.update(self.runCommand(line.split()))
+        return changed
+
+    # Carry out one command, given as a list of words. Returns the indexes of affected drives.
+    def runCommand(self, words):
+        if len(words) == 0:
+            return []
+        if words[0] == "quit":
+            self.running = False
+            return []
+        if words[0] == "job" and len(words) == 3 and words[2] in PIPELINES and words[1] in self.driveIndex:
+            self.jobScheduler.addJob(self.drives[self.driveIndex[words[1]]], PIPELINES[words[2]])
+            return [self.driveIndex[words[1]]]
+        if len(words) != 2 or words[1] not in self.driveIndex:
+            return []
+        i = self.driveIndex[words[1]]
+        drive = self.drives[i]
+        if words[0] == "query":
+            drive.initiateQuery()
+        elif words[0] == "short":
+            drive.runShortTest()
+        elif words[0] == "long":
+            drive.runLongTest()
+        elif words[0] == "abort":
+            self.jobScheduler.cancelJob(drive)
+            drive.abortTest()
+        elif words[0] == "cancel":
+            self.jobScheduler.cancelJob(drive)
+        return [i]
+
+
+# A line of the detail pane that stands in for an Attribute.
+class AttributeLine(object):
+    def __init__(self, smartctlLine, hasWhenFailed):
+        self.smartctlLine = smartctlLine
+        self.hasWhenFailed = hasWhenFailed
+
+
+# The interface's view of a drive owned by the collector. Reads like a Drive; commands are sent to the collector.
+class RemoteDrive(object):
+    def __init__(self, client, devicePath):
+        self.client = client
+        self.devicePath = devicePath
+        self.name = devicePath
+        self.sequence = None  # Sequence counter of the record last loaded.
+        self.load((DR_STATE_QUERYING, 0, NOT_INITIALIZED, NOT_INITIALIZED, SMART_STATUS_CODE_NOT_INITIALIZED,
+                   devicePath, "", "", "", "", "", DR_STATE_MSG[DR_STATE_QUERYING], "",
+                   SMART_STATUS_CODE_NOT_INITIALIZED_MSG, ""))
+
+    # Fill the fields from record values.
+    def load(self, values):
+        values = [value.rstrip('\0') if isinstance(value, str) else value for value in values]
+        self.state, flags, self.reallocCount, self.hours, self.smartStatusCode, self.devicePath, \
+            self.rotationRate, self.capacity, self.model, self.serial, self.GSenseCount, self.status, self.eta, \
+            self.smartStatusDescription, detail = values
+        self.smartCapable = bool(flags & FLAG_SMART_CAPABLE)
+        self.unknownUSBBridge = bool(flags & FLAG_UNKNOWN_USB_BRIDGE)
+        self.failureHistory = bool(flags & FLAG_FAILURE_HISTORY)
+        self.failedAttributes = bool(flags & FLAG_FAILED_ATTRIBUTES)
+        self.jobActive = bool(flags & FLAG_JOB_ACTIVE)
+        self.importantAttributes = list()
+        self.testHistoryHeader = ""
+        self.testHistory = list()
+        self.coverage = ""
+        for line in detail.split('\n') if detail else []:
+            if line[0] == DETAIL_COVERAGE:
+                self.coverage = line[1:]
+            elif line[0] in [DETAIL_ATTRIBUTE, DETAIL_FAILED_ATTRIBUTE]:
+                self.importantAttributes.append(AttributeLine(line[1:], line[0] == DETAIL_FAILED_ATTRIBUTE))
+            elif line[0] == DETAIL_HISTORY_HEADER:
+                self.testHistoryHeader = line[1:]
+            else:
+                self.testHistory.append(line[1:])
+
+    def initiateQuery(self):
+        self.client.send("query", self.devicePath)
+
+    # The collector finishes queries; this view only ever holds a finished or in-flight state.
+    def queryIsDone(self):
+        return self.state != DR_STATE_QUERYING
+
+    def runShortTest(self):
+        self.client.send("short", self.devicePath)
+
+    def runLongTest(self):
+        self.client.send("long", self.devicePath)
+
+    def abortTest(self):
+        self.client.send("abort", self.devicePath)
+
+    def matchSearchString(self, searchString):
+        return any(re.search(searchString, field, re.IGNORECASE)
+                   for field in [self.serial, self.model, self.devicePath, self.name])
+
+    # Status as published by the collector (the job's status if the drive has one).
+    def statusString(self):
+        return self.status
+
+    def hasFailedAttributes(self):
+        return self.failedAttributes
+
+    def hasFailureHistory(self):
+        return self.failureHistory
+
+    def testTimeRemaining(self):
+        return self.eta
+
+    def spanCoverage(self):
+        return self.coverage
+
+
+# The interface's stand-in for the collector's JobScheduler.
+class RemoteJobScheduler(object):
+    def __init__(self, client):
+        self.client = client
+
+    def addJob(self, drive, stageClasses):
+        for name, pipeline in PIPELINES.items():
+            if pipeline == stageClasses:
+                self.client.send("job", drive.devicePath, name)
+
+    # Job status is already part of the drive's published status.
+    def jobFor(self, drive):
+        return None
+
+    def cancelJob(self, drive):
+        self.client.send("cancel", drive.devicePath)
+
+    def hasActiveJobs(self):
+        return any(drive.jobActive for drive in self.client.drives)
+
+    # The collector advances jobs; changes arrive with the drive records.
+    def update(self):
+        return False
+
+
+# The interface's end of a running collector.
+class CollectorClient(object):
+    def __init__(self, devicePaths, pid, table, commandFd):
+        self.pid = pid
+        self.table = table
+        self.commandFd = commandFd
+        self.running = True
+        self.allDrives = [RemoteDrive(self, devicePath) for devicePath in devicePaths]
+        self.drives = list(self.allDrives)  # Drives to show (those behind unknown USB bridges are dropped).
+        self.jobScheduler = RemoteJobScheduler(self)
+
+    # Send a command to the collector.
+    def send(self, *words):
+        if not self.running:
+            return
+        try:
+            os.write(self.commandFd, ' '.join(words) + '\n')  # Lines are shorter than PIPE_BUF, so writes are atomic.
+        except OSError as error:
+            if error.errno != errno.EPIPE:
+                raise
+            self.running = False
+
+    # Load every record that the collector has changed. Returns True if any did.
+    def update(self):
+        changed = False
+        for i, drive in enumerate(self.allDrives):
+            if self.table.sequence(i) == drive.sequence:
+                continue
+            sequence, values = self.table.read(i)
+            if sequence is None or sequence == 0:
+                continue  # Still being written, or never published.
+            drive.load(values)
+            drive.sequence = sequence
+            if drive.unknownUSBBridge and drive in self.drives:
+                self.drives.remove(drive)
+            changed = True
+        return changed
+
+    # Test whether the collector process is still alive.
+    def isRunning(self):
+        if self.running and os.waitpid(self.pid, os.WNOHANG)[0] != 0:
+            self.running = False
+        return self.running
+
+    # Ask the collector to finish and wait for it.
+    def stop(self):
+        self.send("quit")
+        os.close(self.commandFd)
+        if self.running:
+            os.waitpid(self.pid, 0)
+            self.running = False
+
+
+# Fork a collector process for the given drives and return the interface's end of it.
+def startCollector(devicePaths):
+    table = SharedTable(len(devicePaths), RECORD_FORMAT)
+    readFd, writeFd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(writeFd)
+        exitCode = 1
+        try:
+            Collector(devicePaths, table, readFd).run()
+            exitCode = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(exitCode)
+    os.close(readFd)
+    return CollectorClient(devicePaths, pid, table, writeFd)
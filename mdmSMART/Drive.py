@@ -2,11 +2,12 @@
 
 import os
 import re
-import subprocess
 import warnings
 import datetime
 
 from Attribute import Attribute
+from SpanTest import coverageLine
+from Supervisor import *
 from mdmSMART.utils import *
 
 # Test result messages that are innocuous.
@@ -16,15 +17,18 @@ harmlessTestMessages = ["Aborted by host", "Completed without error", "Self-test
 # Open the null device for dumping unwanted output into.
 DEVNULL = open(os.devnull, 'w')
 
+# Command used to run smartctl (can be pointed at a stand-in such as the smartsim drive simulator).
+SMARTCTL = os.environ.get("MDM_SMARTCTL", "smartctl")
+
 # Possible states of a device's history: all past tests were good, one or more were bad, drive has never run a
 #   short or long test, drive has never run a long test (but short ones were all good), drive has no history
 #   because it is not SMART test capable.
 DR_HIST_GOOD, DR_HIST_BAD, DR_HIST_NEVER_TESTED, DR_HIST_NEVER_LONG_TESTED, DR_HIST_NOT_TESTABLE = range(5)
 
 # Possible drive states of an instance of this class.
-numberOfPossibleDriveStates = 5
+numberOfPossibleDriveStates = 7
 DR_STATE_UNKNOWN, DR_STATE_IDLE, DR_STATE_QUERYING, DR_STATE_TESTING,\
-    DR_STATE_WIPING = range(numberOfPossibleDriveStates)
+    DR_STATE_WIPING, DR_STATE_TIMEOUT, DR_STATE_STANDBY = range(numberOfPossibleDriveStates)
 
 # Status descriptions.
 DR_STATE_MSG = [None] * numberOfPossibleDriveStates  # Create empty list of given size.
@@ -33,6 +37,8 @@ DR_STATE_MSG[DR_STATE_IDLE] = "Idle"
 DR_STATE_MSG[DR_STATE_QUERYING] = "Querying"
 DR_STATE_MSG[DR_STATE_TESTING] = "Testing"  # Drive is testing but type of test is unknown.
 DR_STATE_MSG[DR_STATE_WIPING] = "Wiping"
+DR_STATE_MSG[DR_STATE_TIMEOUT] = "Timed out"  # Drive didn't answer a smartctl query in time.
+DR_STATE_MSG[DR_STATE_STANDBY] = "Standby"  # Drive is spun down and was left that way.
 
 # Class-related constants.
 DR_LOAD_FAILED, DR_LOAD_SUCCESS = range(2)
@@ -42,6 +48,10 @@ SMART_STATUS_CODE_NOT_INITIALIZED_MSG = "SMART status code not initialized."
 SMART_STATUS_CODE_NOT_FOUND = -2
 SMART_STATUS_CODE_NOT_FOUND_MSG = "SMART status code not found in smartctl output."
 NUMBER_OF_SMARTCTL_STATE_CODES = 256
+QUERY_TIMEOUT_SECS = 60  # Longest a smartctl query may run before the drive is considered hung.
+COMMAND_TIMEOUT_SECS = 30  # Longest a smartctl test start or abort command may run.
+SMARTCTL_EXIT_FAILED = 3  # Bits of smartctl's exit status that mean the command or device open failed.
+STANDBY_PATTERN = r"Device is in (STANDBY|SLEEP)"  # What smartctl -n standby prints instead of waking a drive.
 
 # Smart test status codes.
 SMART_CODE_IDLE = [0, 1]  # Drive is not smart testing.
@@ -53,6 +63,8 @@ SMART_CODE_READ_FAILURE = [112, 118]  # Drive failed most recent test with read
 # Attribute ID numbers.
 ATTR_REALLOC = 5
 ATTR_HOURS = 9
+ATTR_PENDING = 197
+ATTR_UNCORRECTABLE = 198
 ATTR_GSENSE1 = 191
 ATTR_GSENSE2 = 221
 
@@ -60,221 +72,465 @@ ATTR_GSENSE2 = 221
 IMPORTANT_ATTRIBUTES = [ATTR_REALLOC, ATTR_HOURS, ATTR_GSENSE1, ATTR_GSENSE2, 10, 184, 187, 188, 196, 197, 198, 201]
 
 
+# Everything known about a drive from smartctl, and its state, with the values a drive starts with.
+SNAPSHOT_DEFAULTS = {
+    "attributes": (None,) * 256,  # Attributes by ID number (None where the drive has no such attribute).
+    "capacity": "",  # Drive size in MB, GB or TB as a string.
+    "connector": "",  # Interface type (SATA, ATA, SAS, ..).
+    "estimatedCompletionTime": None,
+    "GSenseCount": "",
+    "hours": NOT_INITIALIZED,
+    "importantAttributes": (),  # Attributes that should always be shown (like WHEN_FAILs).
+    "lastQueryLatency": None,  # Seconds the most recent finished smartctl query took.
+    "lastTestAborted": False,  # Drive has a test abortion in-progress.
+    "lbaCount": NOT_INITIALIZED,  # Number of logical sectors (for selective self-tests of LBA spans).
+    "longTestMinutes": NOT_INITIALIZED,  # Time the drive recommends polling an extended self-test after.
+    "model": "",
+    "pendingCount": NOT_INITIALIZED,  # Sectors waiting to be remapped.
+    "queryCount": 0,  # Number of smartctl queries finished.
+    "queryFailures": 0,  # Number of smartctl queries that timed out or couldn't open the device.
+    "reallocCount": NOT_INITIALIZED,  # Marker value for uninitialized integer.
+    "rotationRate": "",  # RPM (5400, 7200, ..) or SSD.
+    "selectiveSpan": None,  # First and last LBA of the first span in the selective self-test log.
+    "serial": "",
+    "smartCapable": False,  # Assume a drive is not SMART-capable until proven otherwise.
+    "smartEnabled": False,  # SMART has been seen enabled this session, so it needn't be enabled again.
+    "smartctlOutput": "",  # All smartctl output as a single string.
+    "smartctlLines": ("",),  # All smartctl output as a tuple of strings, one per line.
+    "smartStatusCode": SMART_STATUS_CODE_NOT_INITIALIZED,
+    "smartStatusDescription": SMART_STATUS_CODE_NOT_INITIALIZED_MSG,
+    "state": DR_STATE_UNKNOWN,
+    "testAnchor": None,  # Time and percentage done when a query first saw the running test (to predict its end).
+    "testHistory": (),  # Strings, one per test result from SMART test history.
+    "testHistoryHeader": "",  # Test history column header as given by smartctl.
+    "testPercentage": NOT_INITIALIZED,  # Percentage completion of test.
+    "unknownUSBBridge": False,
+    "uncorrectableCount": NOT_INITIALIZED,  # Sectors that couldn't be read or corrected.
+}
+
+
+# An immutable version of everything known about a drive. Changing anything means building a new snapshot (with
+#   derive), which shares the unchanged values, attributes and tuples with the old one; the old one stays valid for
+#   anyone still reading it.
+class DriveSnapshot(object):
+    __slots__ = tuple(sorted(SNAPSHOT_DEFAULTS))
+
+    def __init__(self, fields):
+        for name in self.__slots__:
+            object.__setattr__(self, name, fields[name])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("drive snapshots can't be changed")
+
+    def __delattr__(self, name):
+        raise AttributeError("drive snapshots can't be changed")
+
+    # Snapshots are pickled by their fields (eg, to hand them between processes).
+    def __reduce__(self):
+        return DriveSnapshot, (self.fields(),)
+
+    # The fields as a new dict.
+    def fields(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    # A new snapshot with some fields changed.
+    def derive(self, **changes):
+        fields = self.fields()
+        fields.update(changes)
+        return DriveSnapshot(fields)
+
+    # Return the drive status description as a short string.
+    def statusString(self):
+        if self.state is DR_STATE_TESTING and 241 <= self.smartStatusCode <= 249:
+            return DR_STATE_MSG[self.state] + " " + str(self.testPercentage) + "%"
+        return DR_STATE_MSG[self.state]
+
+    # If any attribute has something other than a dash for WHEN_FAIL then return True.
+    def hasFailedAttributes(self):
+        for attribute in self.attributes:
+            if attribute and attribute.hasWhenFailed:
+                return True
+        return False
+
+    # If any past test failed.
+    def hasFailureHistory(self):
+        for test in self.testHistory:
+            if not any(msg in test for msg in harmlessTestMessages):
+                return True
+        return False
+
+    # Return remaining test time (ETA) as string.
+    def testTimeRemaining(self):
+        # If an test completion time is known then calculate
+        if self.estimatedCompletionTime:
+            timeDelta = self.estimatedCompletionTime - datetime.datetime.now()
+            hours, minutes = timeDelta.days * 24 + timeDelta.seconds // 3600, timeDelta.seconds // 60 % 60
+            if hours is not 0:
+                return str(hours) + "h " + str(minutes) + "m"
+            elif minutes is not 0:
+                return str(minutes) + "m"
+            else:
+                return str(timeDelta.seconds) + "s"
+        else:
+            return ""
+
+
+EMPTY_SNAPSHOT = DriveSnapshot(SNAPSHOT_DEFAULTS)
+
+
+# The given items as a tuple, or the previous tuple itself if it has the same items.
+def sharedTuple(items, previousItems):
+    items = tuple(items)
+    return previousItems if items == previousItems else items
+
+
+# Predicted completion time of a running self-test whose ETA smartctl didn't give (eg, one started by another
+#   program), from the first query that saw it (the anchor). The rest of the test is taken to go at the pace of the
+#   drive's recommended extended test time (its share of that for a selective test's span), or quicker if the test
+#   has been seen going quicker (as a short test does).
+def predictCompletion(fields, anchor, smartctlOutput):
+    now = datetime.datetime.now()
+    anchorTime, anchorPercentage = anchor or (now, fields["testPercentage"])
+    testMinutes = fields["longTestMinutes"]
+    if testMinutes == NOT_INITIALIZED:
+        return None
+    span = fields["selectiveSpan"]
+    spanTesting = re.search(r"SPAN\s+MIN_LBA.*\n\s*1\s.*in_progress", smartctlOutput, re.IGNORECASE)
+    if span and spanTesting and fields["lbaCount"] > 0:
+        testMinutes *= (span[1] - span[0] + 1) / float(fields["lbaCount"])
+    secsPerPercent = testMinutes * 60 / 100.0
+    if fields["testPercentage"] > anchorPercentage:
+        seenSecsPerPercent = (now - anchorTime).total_seconds() / (fields["testPercentage"] - anchorPercentage)
+        secsPerPercent = min(secsPerPercent, seenSecsPerPercent)
+    return anchorTime + datetime.timedelta(seconds=(100 - anchorPercentage) * secsPerPercent)
+
+
+# Interpret raw smartctl output as a new snapshot following a previous one. Values the output doesn't give are
+#   carried over from the previous snapshot, and unchanged attributes and lists are shared with it.
+def parseSmartctlOutput(smartctlOutput, previous):
+    fields = previous.fields()
+    fields["smartctlOutput"] = smartctlOutput
+    if smartctlOutput == previous.smartctlOutput:
+        smartctlLines = previous.smartctlLines
+    else:
+        smartctlLines = tuple(smartctlOutput.split('\n'))
+    fields["smartctlLines"] = smartctlLines
+    if re.search("Unknown USB bridge", smartctlOutput):
+        fields["unknownUSBBridge"] = True
+        fields["smartCapable"] = False
+        return DriveSnapshot(fields)  # Don't bother reading smartctl output if it's an unbridged USB device.
+    else:
+        fields["smartCapable"] = True
+
+    # Pull out the easy-to-capture values.
+    fields["serial"] = capture(r"Serial Number:\s*(.+)", smartctlOutput)
+    fields["model"] = capture(r"Device Model:\s*(.+)", smartctlOutput)
+
+    # Whether SMART is on. Output from "-s on" reports support as it was before enabling, then "SMART Enabled.". A
+    #   different drive in the same slot must be enabled afresh.
+    if re.search(r"SMART support is:\s*Enabled|^SMART Enabled\.", smartctlOutput, re.MULTILINE):
+        fields["smartEnabled"] = True
+    elif re.search(r"SMART support is:\s*Disabled", smartctlOutput) or fields["serial"] != previous.serial:
+        fields["smartEnabled"] = False
+
+    # Determine the rotation rate or detect SSD.
+    fields["rotationRate"] = capture(r"Rotation Rate:\s*(\d+)", smartctlOutput)
+    if fields["rotationRate"] == CAPTURE_FAILED:
+        if firstMatchPosition("Solid State Device", smartctlOutput) is not SEARCH_FAILED:
+            fields["rotationRate"] = "SSD"
+
+    # Search for SMART status code in smartctl output.
+    smartStatusCodeSearch = capture(r"Self-test execution status:\s*\(\s*(\d+)\s*\)", smartctlOutput)
+
+    # If smart status code wasn't found in smartctl output then.
+    if smartStatusCodeSearch is CAPTURE_FAILED:
+        fields["smartStatusCode"] = SMART_STATUS_CODE_NOT_INITIALIZED
+        fields["smartStatusDescription"] = SMART_STATUS_CODE_NOT_FOUND_MSG
+        # If smart status code is unavailable and drive is not being wiped then presume drive is idle.
+        if previous.state is not DR_STATE_WIPING:
+            fields["state"] = DR_STATE_IDLE
+    # If SMART status code was found then record that status.
+    else:
+        smartStatusCode = fields["smartStatusCode"] = int(smartStatusCodeSearch)
+        # Look for smartctl status codes that imply the drive is idle.
+        if smartStatusCode in SMART_CODE_IDLE + [SMART_CODE_INTERRUPTED, SMART_CODE_INTERRUPTED2] + \
+                SMART_CODE_ABORTED:
+            fields["state"] = DR_STATE_IDLE
+        # Look for smartctl status codes that imply the drive is running a test.
+        elif smartStatusCode in range(241, 250):  # Range of SMART testing codes = 241-249.
+            fields["state"] = DR_STATE_TESTING
+            fields["testPercentage"] = (250 - smartStatusCode) * 10
+        # If smartctl status code is not recognized that specify the drive state as unknown.
+        else:
+            fields["state"] = DR_STATE_UNKNOWN
+        # Search for SMART status message in smartctl output.
+        smartStatusDescSearch = capture(r"Self-test execution status:\s*\(\s*\d+\s*\)\s*(.*)", smartctlOutput)
+        # If status description wasn't found then report that fact.
+        if smartStatusDescSearch is "":
+            fields["smartStatusDescription"] = "SMART status description could not be found in smartctl output."
+        # If status description was found then use it.
+        else:
+            # Capture status description and then look for subsequent lines if it's a multiline description.
+            smartStatusDescription = smartStatusDescSearch
+            # Find the start of the description line.
+            smartStatusDescLineStartPos = firstMatchPosition(r"Self-test execution status:", smartctlOutput)
+            # Get a string from start of description onwards.
+            smartStatusLineOnwards = smartctlOutput[smartStatusDescLineStartPos:]
+            while True:
+                # Find the end of the current description line.
+                smartStatusDescEndOfLine = firstMatchPosition(r"\n", smartStatusLineOnwards)
+                # Get a string from the end of the current line onwards.
+                smartStatusDescNextLineOnwards = smartStatusLineOnwards[smartStatusDescEndOfLine + 1:]
+                # Search for whitespace at start of next line (ie, indentation).
+                smartStatusDescNextLinePos = firstMatchPosition(r"^\s", smartStatusDescNextLineOnwards)
+                # If next line is indented.
+                if smartStatusDescNextLinePos is not SEARCH_FAILED:
+                    # Capture the next line of multiline description and ensure appended line has a space.
+                    smartStatusDescSearch = capture(r"\s*(.*)", smartStatusDescNextLineOnwards)
+                    smartStatusDescription += " " + smartStatusDescSearch
+                    # Remove any double-spaces introduced by spaces at end of lines and appended spaces.
+                    smartStatusDescription = ' '.join(smartStatusDescription.split())
+                    # Get a string from position in description onwards.
+                    smartStatusLineOnwards = smartStatusDescNextLineOnwards[smartStatusDescNextLinePos:]
+                else:
+                    break
+            fields["smartStatusDescription"] = smartStatusDescription
+
+    # If testing is not now occurring then ensure that test timing estimates are disabled.
+    if fields["state"] is not DR_STATE_TESTING:
+        fields["estimatedCompletionTime"] = None
+        fields["testPercentage"] = NOT_INITIALIZED
+        fields["testAnchor"] = None
+
+    # Determine the interface type.
+    if firstMatchPosition(r"SATA Version is:", smartctlOutput) is not SEARCH_FAILED:
+        fields["connector"] = "SATA"
+    elif firstMatchPosition(r"Transport protocol:\s*SAS", smartctlOutput) is not SEARCH_FAILED:
+        fields["connector"] = "SAS"
+    elif firstMatchPosition(r"ATA Version is:", smartctlOutput) is not SEARCH_FAILED:
+        fields["connector"] = "ATA"
+
+    # Look for drive size.
+    fields["capacity"] = capture(r"User Capacity:\s*.*\[(.*)\]", smartctlOutput)
+    capacityBytes = capture(r"User Capacity:\s*([\d,]+) bytes", smartctlOutput)
+    if capacityBytes is not CAPTURE_FAILED:
+        sectorSize = capture(r"Sector Sizes?:\s*(\d+) bytes logical", smartctlOutput) or "512"
+        fields["lbaCount"] = int(capacityBytes.replace(",", "")) // int(sectorSize)
+
+    # Look for self-test log.
+    startOfTestHistory = firstMatchPosition("SMART Self-test log structure", smartctlOutput)
+    if startOfTestHistory is not SEARCH_FAILED:
+        linesFromTestLogStart = smartctlOutput[startOfTestHistory:].split('\n')
+        fields["testHistoryHeader"] = linesFromTestLogStart[1]  # Header is first line after search match.
+        # Each test result is a line that starts with a pound sign.
+        testHistory = [line for line in linesFromTestLogStart if len(line) > 0 and line[0] == '#']
+        fields["testHistory"] = sharedTuple(testHistory, previous.testHistory)
+
+    # Look for the first span of the selective self-test log.
+    selectiveSpan = re.search(r"SPAN\s+MIN_LBA\s+MAX_LBA\s+CURRENT_TEST_STATUS\s*\n\s*1\s+(\d+)\s+(\d+)",
+                              smartctlOutput)
+    fields["selectiveSpan"] = (int(selectiveSpan.group(1)), int(selectiveSpan.group(2))) if selectiveSpan else None
+
+    # Look for how long the drive expects an extended self-test to take.
+    longTestMinutes = capture(r"Extended self-test routine\s*\n\s*recommended polling time:\s*\(\s*(\d+)\)",
+                              smartctlOutput)
+    if longTestMinutes is not CAPTURE_FAILED:
+        fields["longTestMinutes"] = int(longTestMinutes)
+
+    # Predict when a running test will finish, unless smartctl said so when this program started it.
+    if fields["state"] is DR_STATE_TESTING and (previous.testAnchor or not previous.estimatedCompletionTime):
+        fields["estimatedCompletionTime"] = predictCompletion(fields, previous.testAnchor, smartctlOutput)
+        fields["testAnchor"] = previous.testAnchor or (datetime.datetime.now(), fields["testPercentage"])
+
+    # Get the drive attributes, reusing those whose lines haven't changed.
+    attributes = list(previous.attributes)
+    importantAttributes = list()
+    for i in range(len(smartctlLines)):
+        # Look for the start of the attributes section.
+        if smartctlLines[i] == "Vendor Specific SMART Attributes with Thresholds:":
+            # Read in each line of the input.
+            for j in range(i + 2, len(smartctlLines)):
+                if len(smartctlLines[j]) > 2:
+                    # Build an Attribute object.
+                    attribute = attributes[int(smartctlLines[j][0:3])]
+                    if attribute is None or attribute.smartctlLine != smartctlLines[j]:
+                        attribute = Attribute(smartctlLines[j])
+                        attributes[attribute.idNumber] = attribute
+                    # Add it to the list of important attributes if it's one that should always be shown.
+                    if attribute.idNumber in IMPORTANT_ATTRIBUTES:
+                        importantAttributes.append(attribute)
+                    # Add it to the list of important attributes if it has a WHEN_FAIL entry.
+                    elif not re.search(r"\w*-\w*", attribute.whenFailed):
+                        importantAttributes.append(attribute)
+                else:
+                    break
+    fields["attributes"] = sharedTuple(attributes, previous.attributes)
+    fields["importantAttributes"] = sharedTuple(importantAttributes, previous.importantAttributes)
+
+    # Extract particular data from the attributes if available.
+    for fieldName, idNumber in [("reallocCount", ATTR_REALLOC), ("hours", ATTR_HOURS), ("pendingCount", ATTR_PENDING),
+                                ("uncorrectableCount", ATTR_UNCORRECTABLE)]:
+        if attributes[idNumber]:
+            valueString = capture(r"([0-9]+)", attributes[idNumber].rawValue)
+            if valueString is not "":
+                fields[fieldName] = int(valueString)
+    if attributes[ATTR_GSENSE1]:
+        fields["GSenseCount"] = attributes[ATTR_GSENSE1].rawValue
+    elif attributes[ATTR_GSENSE2]:
+        fields["GSenseCount"] = attributes[ATTR_GSENSE2].rawValue
+    return DriveSnapshot(fields)
+
+
+# A read-only Drive property that reads a field of the drive's current snapshot.
+def snapshotField(name):
+    return property(lambda drive: getattr(drive.snapshot, name))
+
+
+# A drive being managed. Everything known about it is held in an immutable DriveSnapshot; a change builds a new
+#   snapshot and publishes it by assigning self.snapshot, a single reference swap. A reader on another thread that
+#   takes drive.snapshot once and reads its fields always sees one consistent version (reading several of the
+#   drive's own properties in a row may mix versions). Only one thread at a time may change a drive.
 class Drive(object):
-    def __init__(self, devicePath):
+    def __init__(self, devicePath, smartctlOutput=None):
         # Declare the members of this class.
-        self.attributes = [None] * 256  # Create list of unfilled attributes.
-        self.capacity = ""  # Drive size in MB, GB or TB as a string.
-        self.unknownUSBBridge = False
         self.device = None
         self.devicePath = devicePath
-        self.estimatedCompletionTime = None
-        self.GSenseCount = ""
-        self.hours = NOT_INITIALIZED
-        self.importantAttributes = list()  # Attributes that should always be shown (like WHEN_FAILs).
-        self.lastTestAborted = False  # Drive has a test abortion in-progress.
-        self.model = ""
         self.name = devicePath  # Device is referred to by its path.
-        self.reallocCount = NOT_INITIALIZED  # Marker value for uninitialized integer.
-        self.rotationRate = ""  # RPM (5400, 7200, ..) or SSD.
-        self.serial = ""
-        self.smartCapable = False  # Assume a drive is not SMART-capable until proven otherwise.
-        self.smartctlOutput = ""  # All smartctl output as a single string.
-        self.smartctlLines = list()  # All smartctl output as a list of strings, one per line.
-        self.smartctlProcess = None  # Separate process allows non-blocking call to smartctl.
-        self.smartStatusCode = SMART_STATUS_CODE_NOT_INITIALIZED
-        self.smartStatusDescription = SMART_STATUS_CODE_NOT_INITIALIZED_MSG
-        self.state = DR_STATE_UNKNOWN
-        self.testHistory = list()  # Strings, one per test result from SMART test history.
-        self.testHistoryHeader = ""  # Test history column header as given by smartctl.
-        self.testPercentage = NOT_INITIALIZED  # Percentage completion of test.
-
-        # Start a smartctl process so the device fields can be filled.
-        self.initiateQuery()
-
-    # Run a smartctl process to get latest device info.
-    def initiateQuery(self):
-        command = "smartctl -s on -a " + self.devicePath
-        self.smartctlProcess = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=DEVNULL)
-        self.state = DR_STATE_QUERYING
-
-    # Test if a smartctl query-in-progress has completed.
+        self.smartctlProcess = None  # Supervised process allows non-blocking call to smartctl.
+
+        # Fill the device fields from saved smartctl output if it's given, otherwise from a new smartctl process.
+        if smartctlOutput is not None:
+            self.snapshot = parseSmartctlOutput(smartctlOutput, EMPTY_SNAPSHOT)
+        else:
+            self.snapshot = EMPTY_SNAPSHOT
+            self.initiateQuery()
+
+    attributes = snapshotField("attributes")
+    capacity = snapshotField("capacity")
+    connector = snapshotField("connector")
+    estimatedCompletionTime = snapshotField("estimatedCompletionTime")
+    GSenseCount = snapshotField("GSenseCount")
+    hours = snapshotField("hours")
+    importantAttributes = snapshotField("importantAttributes")
+    lastQueryLatency = snapshotField("lastQueryLatency")
+    lastTestAborted = snapshotField("lastTestAborted")
+    lbaCount = snapshotField("lbaCount")
+    longTestMinutes = snapshotField("longTestMinutes")
+    model = snapshotField("model")
+    pendingCount = snapshotField("pendingCount")
+    queryCount = snapshotField("queryCount")
+    queryFailures = snapshotField("queryFailures")
+    reallocCount = snapshotField("reallocCount")
+    rotationRate = snapshotField("rotationRate")
+    selectiveSpan = snapshotField("selectiveSpan")
+    serial = snapshotField("serial")
+    smartCapable = snapshotField("smartCapable")
+    smartEnabled = snapshotField("smartEnabled")
+    smartctlOutput = snapshotField("smartctlOutput")
+    smartctlLines = snapshotField("smartctlLines")
+    smartStatusCode = snapshotField("smartStatusCode")
+    smartStatusDescription = snapshotField("smartStatusDescription")
+    state = snapshotField("state")
+    testAnchor = snapshotField("testAnchor")
+    testHistory = snapshotField("testHistory")
+    testHistoryHeader = snapshotField("testHistoryHeader")
+    testPercentage = snapshotField("testPercentage")
+    unknownUSBBridge = snapshotField("unknownUSBBridge")
+    uncorrectableCount = snapshotField("uncorrectableCount")
+
+    # Publish a new snapshot with some fields changed.
+    def publish(self, **changes):
+        self.snapshot = self.snapshot.derive(**changes)
+
+    # Option that enables SMART, until the drive has been seen with SMART enabled.
+    def enableOption(self):
+        return "" if self.smartEnabled else "-s on "
+
+    # Run a smartctl process to get latest device info. A query already in flight for this drive is reused, unless
+    #   fresh is set (after a command that changes the drive, whose effect an earlier query can't show). Once a
+    #   drive has been read in full, a drive in standby is left spun down (and reported as such) rather than
+    #   woken, unless wake is set. Any changes given are published along with the querying state.
+    def initiateQuery(self, fresh=False, wake=False, **changes):
+        standbyOption = "-n standby " if self.smartCapable and not wake else ""
+        command = SMARTCTL + " " + self.enableOption() + standbyOption + "-a " + self.devicePath
+        self.smartctlProcess = supervisor.spawn(command, key=self.devicePath, timeoutSecs=QUERY_TIMEOUT_SECS,
+                                                reuse=not fresh)
+        self.publish(state=DR_STATE_QUERYING, **changes)
+
+    # Test if a smartctl query-in-progress has completed (or timed out).
     def queryIsDone(self):
         # If smartctl query terminal command has completed then update self based on terminal output.
         if self.state == DR_STATE_QUERYING:
-            if self.smartctlProcess.poll() is not None:
-                self.smartctlOutput, _ = self.smartctlProcess.communicate()
-                self.smartctlLines = self.smartctlOutput.split('\n')
-                self.interpretSmartctlOutput()
+            if self.smartctlProcess.poll() != PROC_RUNNING:
+                self.finishQuery()
                 return True  # Query has just completed.
             else:
                 return False  # Querying but smartctl has not completed.
         else:
             return True  # Not querying.
 
-    # Interpret the current stored raw output of smartctl to fill device fields.
-    def interpretSmartctlOutput(self):
-        if re.search("Unknown USB bridge", self.smartctlOutput):
-            self.unknownUSBBridge = True
-            self.smartCapable = False
-            return  # Don't bother reading smartctl output if it's an unbridged USB device.
-        else:
-            self.smartCapable = True
-
-        # Pull out the easy-to-capture values.
-        self.serial = capture(r"Serial Number:\s*(.+)", self.smartctlOutput)
-        self.model = capture(r"Device Model:\s*(.+)", self.smartctlOutput)
-
-        # Determine the rotation rate or detect SSD.
-        self.rotationRate = capture(r"Rotation Rate:\s*(\d+)", self.smartctlOutput)
-        if self.rotationRate == CAPTURE_FAILED:
-            if firstMatchPosition("Solid State Device", self.smartctlOutput) is not SEARCH_FAILED:
-                self.rotationRate = "SSD"
-
-        # Search for SMART status code in smartctl output.
-        smartStatusCodeSearch = capture(r"Self-test execution status:\s*\(\s*(\d+)\s*\)", self.smartctlOutput)
-
-        # If smart status code wasn't found in smartctl output then.
-        if smartStatusCodeSearch is CAPTURE_FAILED:
-            self.smartStatusCode = SMART_STATUS_CODE_NOT_INITIALIZED
-            self.smartStatusDescription = SMART_STATUS_CODE_NOT_FOUND_MSG
-            # If smart status code is unavailable and drive is not being wiped then presume drive is idle.
-            if self.state is not DR_STATE_WIPING:
-                self.state = DR_STATE_IDLE
-        # If SMART status code was found then record that status.
-        else:
-            self.smartStatusCode = int(smartStatusCodeSearch)
-            # Look for smartctl status codes that imply the drive is idle.
-            if self.smartStatusCode in SMART_CODE_IDLE + [SMART_CODE_INTERRUPTED, SMART_CODE_INTERRUPTED2] + \
-                    SMART_CODE_ABORTED:
-                self.state = DR_STATE_IDLE
-            # Look for smartctl status codes that imply the drive is running a test.
-            elif self.smartStatusCode in range(241, 250):  # Range of SMART testing codes = 241-249.
-                self.state = DR_STATE_TESTING
-                completionPercentage = (250 - self.smartStatusCode) * 10
-                self.testPercentage = completionPercentage
-            # If smartctl status code is not recognized that specify the drive state as unknown.
-            else:
-                self.state = DR_STATE_UNKNOWN
-            # Search for SMART status message in smartctl output.
-            smartStatusDescSearch = capture(r"Self-test execution status:\s*\(\s*\d+\s*\)\s*(.*)", self.smartctlOutput)
-            # If status description wasn't found then report that fact.
-            if smartStatusDescSearch is "":
-                self.smartStatusDescription = "SMART status description could not be found in smartctl output."
-            # If status description was found then use it.
-            else:
-                # Capture status description and then look for subsequent lines if it's a multiline description.
-                self.smartStatusDescription = smartStatusDescSearch
-                # Find the start of the description line.
-                smartStatusDescLineStartPos = firstMatchPosition(r"Self-test execution status:", self.smartctlOutput)
-                # Get a string from start of description onwards.
-                smartStatusLineOnwards = self.smartctlOutput[smartStatusDescLineStartPos:]
-                while True:
-                    # Find the end of the current description line.
-                    smartStatusDescEndOfLine = firstMatchPosition(r"\n", smartStatusLineOnwards)
-                    # Get a string from the end of the current line onwards.
-                    smartStatusDescNextLineOnwards = smartStatusLineOnwards[smartStatusDescEndOfLine + 1:]
-                    # Search for whitespace at start of next line (ie, indentation).
-                    smartStatusDescNextLinePos = firstMatchPosition(r"^\s", smartStatusDescNextLineOnwards)
-                    # If next line is indented.
-                    if smartStatusDescNextLinePos is not SEARCH_FAILED:
-                        # Capture the next line of multiline description and ensure appended line has a space.
-                        smartStatusDescSearch = capture(r"\s*(.*)", smartStatusDescNextLineOnwards)
-                        self.smartStatusDescription += " " + smartStatusDescSearch
-                        # Remove any double-spaces introduced by spaces at end of lines and appended spaces.
-                        self.smartStatusDescription = ' '.join(self.smartStatusDescription.split())
-                        # Get a string from position in description onwards.
-                        smartStatusLineOnwards = smartStatusDescNextLineOnwards[smartStatusDescNextLinePos:]
-                    else:
-                        break
-
-        # If testing is not now occurring then ensure that test timing estimates are disabled.
-        if self.state is not DR_STATE_TESTING:
-            self.resetTestCompletion()
-
-        # Look for drive size.
-        self.capacity = capture(r"User Capacity:\s*.*\[(.*)\]", self.smartctlOutput)
-
-        # Look for self-test log.
-        startOfTestHistory = firstMatchPosition("SMART Self-test log structure", self.smartctlOutput)
-        if startOfTestHistory is not SEARCH_FAILED:
-            self.testHistory = list()  # Reset test history.
-            linesFromTestLogStart = self.smartctlOutput[startOfTestHistory:].split('\n')
-            self.testHistoryHeader = linesFromTestLogStart[1]  # Header is first line after search match.
-            for line in linesFromTestLogStart:
-                # For each test result (lines that start with a # sign).
-                if len(line) > 0 and line[0] == '#':  # Test result lines start with a pound sign.
-                    self.testHistory.append(line)
-
-        # Get the drive attributes.
-        self.importantAttributes = list()  # Reset attribute list.
-        for i in range(len(self.smartctlLines)):
-            # Look for the start of the attributes section.
-            if self.smartctlLines[i] == "Vendor Specific SMART Attributes with Thresholds:":
-                # Read in each line of the input.
-                for j in range(i + 2, len(self.smartctlLines)):
-                    if len(self.smartctlLines[j]) > 2:
-                        # Build an Attribute object.
-                        attribute = Attribute(self.smartctlLines[j])
-                        self.attributes[attribute.idNumber] = attribute
-                        # Add it to the list of important attributes if it's one that should always be shown.
-                        if attribute.idNumber in IMPORTANT_ATTRIBUTES:
-                            self.importantAttributes.append(attribute)
-                        # Add it to the list of important attributes if it has a WHEN_FAIL entry.
-                        elif not re.search(r"\w*-\w*", attribute.whenFailed):
-                            self.importantAttributes.append(attribute)
-                    else:
-                        break
-
-        # Extract particular data from the attributes if available.
-        if self.attributes[5]:
-            reallocString = capture(r"([0-9]+)", self.attributes[5].rawValue)
-            if reallocString is not "":
-                self.reallocCount = int(reallocString)
-        if self.attributes[9]:
-            hoursString = capture(r"([0-9]+)", self.attributes[9].rawValue)
-            if hoursString is not "":
-                self.hours = int(hoursString)
-        if self.attributes[ATTR_GSENSE1]:
-            self.GSenseCount = self.attributes[ATTR_GSENSE1].rawValue
-        elif self.attributes[ATTR_GSENSE2]:
-            self.GSenseCount = self.attributes[ATTR_GSENSE2].rawValue
+    # Block until a smartctl query-in-progress has completed or timed out (for programs that don't run a polling
+    #   loop).
+    def waitForQuery(self):
+        if self.state == DR_STATE_QUERYING:
+            self.smartctlProcess.wait()
+            self.finishQuery()
+
+    # Update self from a finished smartctl query, publishing the result as one new snapshot.
+    def finishQuery(self):
+        snapshot = self.snapshot
+        changes = {"queryCount": snapshot.queryCount + 1, "lastQueryLatency": self.smartctlProcess.runTime()}
+        if self.smartctlProcess.status != PROC_DONE:
+            self.publish(queryFailures=snapshot.queryFailures + 1, state=DR_STATE_TIMEOUT, **changes)
+            return
+        # A drive in standby answers with a short notice; everything known from earlier queries still holds.
+        if re.search(STANDBY_PATTERN, self.smartctlProcess.output):
+            self.publish(state=DR_STATE_STANDBY, **changes)
+            return
+        if self.smartctlProcess.returnCode & SMARTCTL_EXIT_FAILED:
+            changes["queryFailures"] = snapshot.queryFailures + 1
+        self.snapshot = parseSmartctlOutput(self.smartctlProcess.output, snapshot.derive(**changes))
 
     def runShortTest(self):
-        self.runTest("smartctl -s on -t short " + self.devicePath)
+        return self.runTest(SMARTCTL + " " + self.enableOption() + "-t short " + self.devicePath)
 
     def runLongTest(self):
-        self.runTest("smartctl -s on -t long " + self.devicePath)
+        return self.runTest(SMARTCTL + " " + self.enableOption() + "-t long " + self.devicePath)
 
-    # Executes a given terminal command that should be a smartctl test.
+    # Self-test the LBAs firstLba to lastLba (inclusive) only.
+    def runSelectiveTest(self, firstLba, lastLba):
+        return self.runTest(SMARTCTL + " " + self.enableOption() + "-t select,%d-%d " % (firstLba, lastLba) +
+                            self.devicePath)
+
+    # Executes a given terminal command that should be a smartctl test. Returns whether the drive reported that the
+    #   test began.
     def runTest(self, command):
         if self.smartCapable and self.state not in [DR_STATE_TESTING, DR_STATE_WIPING]:
-            terminalOutput = terminalCommand(command)
+            terminalOutput = terminalCommand(command, COMMAND_TIMEOUT_SECS)
+            changes = {"lastTestAborted": False}
             eta = capture(r"Test will complete after (.*)", terminalOutput)
             if eta is not CAPTURE_FAILED:
                 # Extract time and date substrings from smartctl output.
                 #   Example: "Thu Mar 15 14:29:51 2018"
-                self.estimatedCompletionTime = datetime.datetime.strptime(eta, "%a %b %d %H:%M:%S %Y")
-            self.state = DR_STATE_TESTING
-            self.initiateQuery()  # Call smartctl a 2nd time to confirm new status as testing.
-            self.lastTestAborted = False
+                changes["estimatedCompletionTime"] = datetime.datetime.strptime(eta, "%a %b %d %H:%M:%S %Y")
+                changes["testAnchor"] = None  # The drive's own ETA needn't be predicted.
+            self.initiateQuery(fresh=True, **changes)  # Call smartctl a 2nd time to confirm new status as testing.
+            return "Testing has begun" in terminalOutput
+        return False
 
     def abortTest(self):
         # Call smartctl directly to abort currently running test.
-        terminalCommand("smartctl -s on -X " + self.devicePath)
-        self.resetTestCompletion()
-        self.state = DR_STATE_UNKNOWN
-        self.lastTestAborted = True
-
-    def resetTestCompletion(self):
-        self.estimatedCompletionTime = None
-        self.testPercentage = NOT_INITIALIZED
+        terminalCommand(SMARTCTL + " " + self.enableOption() + "-X " + self.devicePath, COMMAND_TIMEOUT_SECS)
+        # Then read the drive again, so a query from before the abort can't report the test as still running.
+        self.initiateQuery(fresh=True, estimatedCompletionTime=None, testPercentage=NOT_INITIALIZED,
+                           lastTestAborted=True)
 
     # Test if a given string matches any device field as a substring.
     def matchSearchString(self, searchString):
+        snapshot = self.snapshot
         # Look for the given searchString in various fields.
-        if re.search(searchString, self.serial, re.IGNORECASE) or \
-                re.search(searchString, self.model, re.IGNORECASE) or \
+        if re.search(searchString, snapshot.serial, re.IGNORECASE) or \
+                re.search(searchString, snapshot.model, re.IGNORECASE) or \
                 re.search(searchString, self.devicePath, re.IGNORECASE) or \
                 re.search(searchString, self.name, re.IGNORECASE):
             return True
@@ -283,36 +539,21 @@ class Drive(object):
 
     # Return the drive status description as a short string.
     def statusString(self):
-        if self.state is DR_STATE_TESTING and 241 <= self.smartStatusCode <= 249:
-            completion = (250 - self.smartStatusCode) * 10
-            return DR_STATE_MSG[self.state] + " " + str(self.testPercentage) + "%"
-        return DR_STATE_MSG[self.state]
+        return self.snapshot.statusString()
 
     # If any attribute has something other than a dash for WHEN_FAIL then return True.
     def hasFailedAttributes(self):
-        for attribute in self.attributes:
-            if attribute and attribute.hasWhenFailed:
-                return True
-        return False
+        return self.snapshot.hasFailedAttributes()
 
     # If any past test failed.
     def hasFailureHistory(self):
-        for test in self.testHistory:
-            if not any(msg in test for msg in harmlessTestMessages):
-                return True
-        return False
+        return self.snapshot.hasFailureHistory()
 
     # Return remaining test time (ETA) as string.
     def testTimeRemaining(self):
-        # If an test completion time is known then calculate
-        if self.estimatedCompletionTime:
-            timeDelta = self.estimatedCompletionTime - datetime.datetime.now()
-            hours, minutes = timeDelta.days * 24 + timeDelta.seconds // 3600, timeDelta.seconds // 60 % 60
-            if hours is not 0:
-                return str(hours) + "h " + str(minutes) + "m"
-            elif minutes is not 0:
-                return str(minutes) + "m"
-            else:
-                return str(timeDelta.seconds) + "s"
-        else:
-            return ""
+        return self.snapshot.testTimeRemaining()
+
+    # Return a line showing which LBA spans have passed selective self-tests, or "" if none have been tested.
+    def spanCoverage(self):
+        snapshot = self.snapshot
+        return coverageLine(snapshot.serial, snapshot.lbaCount) if snapshot.serial else ""
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+# Choosing I/O parameters for bulk operations. Drives reach their best sequential throughput at very different
+#   block sizes and numbers of requests in flight (an old IDE drive, a SATA disk, an SSD and a USB bridge all
+#   differ), so before a wipe or verify a short probe measures throughput over a few settings and keeps the best.
+#   Results are cached per drive model (and read/write direction) so each model is only probed once. A Throttle
+#   makes an image file behave like a slow device, for testing.
+import fcntl
+import json
+import os
+import threading
+import time
+
+from BulkIO import stripedTransfer, zeroBlockWriter, deviceSize
+
+TUNING_CACHE_PATH = "/var/tmp/mdm/iotune.json"
+THROTTLE_VARIABLE = "MDM_IO_THROTTLE"  # "<MB per second>,<milliseconds per request>" to throttle bulk I/O.
+
+BLOCK_SIZES = [64 * 1024, 256 * 1024, 1024 * 1024, 4 * 1024 * 1024]  # Candidate bytes per request.
+QUEUE_DEPTHS = [1, 2, 4, 8]  # Candidate requests in flight.
+PROBE_BYTES = 64 * 1024 * 1024  # Most data moved by one probe.
+PROBE_SECS = 0.5  # Longest time one probe runs.
+GOOD_ENOUGH = 0.95  # Prefer the smallest setting that reaches this fraction of the best throughput.
+DEFAULT_ALIGNMENT = 4096
+
+# Directions of transfer, as used in the cache.
+READ, WRITE = "read", "write"
+
+
+# Simulated device speed: a fixed delay per request (which requests in flight overlap) plus a transfer time over a
+#   bus that all requests share.
+class Throttle(object):
+    def __init__(self, bytesPerSec, latencySecs):
+        self.bytesPerSec = float(bytesPerSec)
+        self.latencySecs = latencySecs
+        self.lock = threading.Lock()
+        self.busyUntil = 0.0  # Time the shared bus finishes its queued transfers.
+
+    def wait(self, count):
+        time.sleep(self.latencySecs)
+        with self.lock:
+            self.busyUntil = max(time.time(), self.busyUntil) + count / self.bytesPerSec
+            delay = self.busyUntil - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# The throttle set in the environment, or None.
+def throttleFromEnvironment():
+    setting = os.environ.get(THROTTLE_VARIABLE)
+    if not setting:
+        return None
+    megabytesPerSec, milliseconds = setting.split(",")
+    return Throttle(float(megabytesPerSec) * 1000000, float(milliseconds) / 1000.0)
+
+
+# Boundary that requests should be aligned to: the physical block size of a disk, or the preferred I/O size of a
+#   file.
+def alignmentOf(path):
+    name = os.path.basename(os.path.realpath(path))
+    try:
+        with open("/sys/block/" + name + "/queue/physical_block_size") as sizeFile:
+            return int(sizeFile.read())
+    except (IOError, ValueError):
+        return os.stat(path).st_blksize or DEFAULT_ALIGNMENT
+
+
+# Model name of a disk from sysfs, or None (eg, for an image file).
+def modelOf(path):
+    name = os.path.basename(os.path.realpath(path))
+    try:
+        with open("/sys/block/" + name + "/device/model") as modelFile:
+            return modelFile.read().strip() or None
+    except IOError:
+        return None
+
+
+# Measure throughput (bytes per second) of one setting on the part of the device starting at offset.
+def probe(path, direction, blockSize, depth, offset, throttle=None):
+    if direction == WRITE:
+        flags, transferBlock = os.O_WRONLY, zeroBlockWriter(blockSize)
+    else:
+        flags, transferBlock = os.O_RDONLY, lambda fd, count: len(os.read(fd, count)) == count
+    startTime = time.time()
+    _, bytesDone = stripedTransfer(path, flags, blockSize, depth, transferBlock, None, throttle, offset,
+                                   offset + PROBE_BYTES, startTime + PROBE_SECS)
+    return bytesDone / max(time.time() - startTime, 1e-6), bytesDone
+
+
+# Of (setting, throughput) pairs in increasing setting order, the first within GOOD_ENOUGH of the best.
+def smallestGoodSetting(results):
+    best = max(throughput for _, throughput in results)
+    for setting, throughput in results:
+        if throughput >= best * GOOD_ENOUGH:
+            return setting, throughput
+
+
+# Probe a device and return its best parameters as a dict (blockSize, depth, alignment, bytesPerSec). The block
+#   size is chosen with one request in flight, then the depth with that block size. Each probe covers a new part
+#   of the device so nothing is measured from cache. Write probes overwrite data: only use them before a wipe.
+def tune(path, direction, throttle=None):
+    size = deviceSize(path)
+    alignment = alignmentOf(path)
+    offset = [0]
+
+    def measure(blockSize, depth):
+        if offset[0] + PROBE_BYTES > size:
+            offset[0] = 0  # Small device: start over (some reads may come from cache).
+        throughput, bytesDone = probe(path, direction, blockSize, depth, offset[0], throttle)
+        offset[0] += (bytesDone + alignment - 1) // alignment * alignment
+        return throughput
+
+    blockSizes = [blockSize for blockSize in BLOCK_SIZES if blockSize % alignment == 0] or [alignment]
+    blockSize, _ = smallestGoodSetting([(blockSize, measure(blockSize, 1)) for blockSize in blockSizes])
+    depth, bytesPerSec = smallestGoodSetting([(depth, measure(blockSize, depth)) for depth in QUEUE_DEPTHS])
+    return {"blockSize": blockSize, "depth": depth, "alignment": alignment, "bytesPerSec": int(bytesPerSec)}
+
+
+def readCache(cachePath):
+    try:
+        with open(cachePath) as cacheFile:
+            return json.load(cacheFile)
+    except (IOError, ValueError):
+        return dict()
+
+
+# Cached parameters of a model for a direction, or None.
+def cachedParameters(model, direction, cachePath=TUNING_CACHE_PATH):
+    return readCache(cachePath).get(model, dict()).get(direction)
+
+
+# Store a model's parameters in the cache, which other mdmio processes may be updating at the same time.
+def cacheParameters(model, direction, parameters, cachePath=TUNING_CACHE_PATH):
+    directory = os.path.dirname(cachePath)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(cachePath + ".lock", 'a') as lockFile:
+        fcntl.flock(lockFile, fcntl.LOCK_EX)
+        cache = readCache(cachePath)
+        cache.setdefault(model, dict())[direction] = dict(parameters, measured=time.time())
+        temporaryPath = cachePath + ".%d.tmp" % os.getpid()
+        with open(temporaryPath, 'w') as cacheFile:
+            json.dump(cache, cacheFile, indent=1, sort_keys=True)
+        os.rename(temporaryPath, cachePath)
+
+
+# Parameters for a bulk operation on a device: from the cache if its model has been probed, otherwise probed now
+#   (and cached if the model is known).
+def tunedParameters(path, direction, model=None, throttle=None, cachePath=TUNING_CACHE_PATH):
+    model = model or modelOf(path)
+    if model:
+        parameters = cachedParameters(model, direction, cachePath)
+        if parameters is not None:
+            return parameters
+    parameters = tune(path, direction, throttle)
+    if model:
+        cacheParameters(model, direction, parameters, cachePath)
+    return parameters
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# Keyboard input for curses programs that tells barcode scans apart from typing.
+#   A barcode scanner "types" a whole string faster than any person can, so keys that arrive within a few
+#   milliseconds of each other are gathered into a burst. Bursts long enough to be a barcode are handed over as
+#   one scanned string; anything else is handed over key by key. Waiting for input blocks in select() so no CPU
+#   is used while nothing is happening.
+import select
+import sys
+import time
+
+NO_KEYS_PRESSED = -1
+SCAN_TERMINATORS = [10, 13]  # Enter/return keys that scanners send after a barcode.
+MIN_SCAN_LENGTH = 4  # Shortest burst (not counting terminators) treated as a barcode.
+
+
+class KeyReader(object):
+    def __init__(self, screen, burstThresholdMs, burstDetection=True):
+        self.screen = screen  # Curses window in nodelay mode.
+        self.burstGapSecs = burstThresholdMs / 1000.0  # Longest gap between keys of one burst.
+        self.burstDetection = burstDetection
+        self.burst = list()  # (key, arrival time) pairs of a burst that may still be growing.
+        self.keys = list()  # Keys ready to be handled as typed keys.
+        self.scans = list()  # Complete scanned strings ready to be handled.
+
+    # Read every pending keystroke, timestamp it and sort it into keys or bursts.
+    def poll(self):
+        while True:
+            key = self.screen.getch()
+            if key == NO_KEYS_PRESSED:
+                break
+            now = time.time()
+            if not self.burstDetection:
+                self.keys.append(key)
+            # Navigation and other special keys are never part of a barcode, so they end any burst at once.
+            elif key >= 256 or (key < 32 and key not in SCAN_TERMINATORS):
+                self.endBurst()
+                self.keys.append(key)
+            else:
+                if len(self.burst) > 0 and now - self.burst[-1][1] > self.burstGapSecs:
+                    self.endBurst()
+                self.burst.append((key, now))
+                if key in SCAN_TERMINATORS:
+                    self.endBurst()
+
+        # A burst ends once no key has followed it for the burst gap.
+        if len(self.burst) > 0 and time.time() - self.burst[-1][1] > self.burstGapSecs:
+            self.endBurst()
+
+    # Classify a finished burst as a barcode scan or as ordinary keys.
+    def endBurst(self):
+        keys = [key for key, _ in self.burst]
+        self.burst = list()
+        text = ''.join([chr(key) for key in keys if key not in SCAN_TERMINATORS])
+        if len(text) >= MIN_SCAN_LENGTH:
+            self.scans.append(text)
+        else:
+            self.keys.extend(keys)
+
+    # Return the next typed key or NO_KEYS_PRESSED.
+    def nextKey(self):
+        return self.keys.pop(0) if len(self.keys) > 0 else NO_KEYS_PRESSED
+
+    # Return the next scanned string or None.
+    def nextScan(self):
+        return self.scans.pop(0) if len(self.scans) > 0 else None
+
+    # Sleep until a key arrives or the timeout passes, waking early if an unfinished burst needs classifying.
+    def waitForInput(self, timeoutSecs):
+        if len(self.keys) > 0 or len(self.scans) > 0:
+            return
+        if len(self.burst) > 0:
+            timeoutSecs = max(0, min(timeoutSecs, self.burst[-1][1] + self.burstGapSecs - time.time()))
+        select.select([sys.stdin], [], [], timeoutSecs)
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# Load testing of the Drive query loop against a simulated fleet (see Simulator.py).
+#   The loop runs mdm's own per-frame drive work (a DrivePoller) without curses: it refreshes every drive
+#   periodically, steps the poller and waits between frames for as long as mdm would wait for input. It reports
+#   how long a frame's work takes (the interface's responsiveness), the CPU used by the program and its smartctl
+#   children, and how many queries completed per second.
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import Drive as DriveModule
+from Drive import *
+from Pipeline import JobScheduler
+from Poller import DrivePoller
+from Simulator import createFleet, SIMULATOR_DIR_VARIABLE
+
+SMARTSIM_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "smartsim")
+DEFAULT_DRIVE_COUNTS = [10, 100, 500]
+
+
+# Point Drive (and any smartctl it spawns) at a fleet of simulated drives.
+def useFleet(fleetDir):
+    os.environ[SIMULATOR_DIR_VARIABLE] = fleetDir
+    DriveModule.SMARTCTL = sys.executable + " " + SMARTSIM_PATH
+
+
+# Value below which the given fraction of a list of numbers falls.
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] if len(ordered) > 0 else 0.0
+
+
+# Run the query loop against driveCount simulated drives for durationSecs and return a dict of measurements.
+def runLoadTest(driveCount, durationSecs=30.0, refreshSecs=5.0, testingFraction=0.1, **fleetOptions):
+    fleetDir = tempfile.mkdtemp(prefix="mdmfleet.")
+    try:
+        devicePaths = createFleet(fleetDir, driveCount, **fleetOptions)
+        useFleet(fleetDir)
+
+        cpuStart = os.times()
+        startTime = time.time()
+        drives = [Drive(devicePath) for devicePath in devicePaths]
+        for drive in drives:
+            drive.waitForQuery()
+
+        # Start tests on some of the drives so the fleet isn't all idle.
+        for drive in drives[:int(driveCount * testingFraction)]:
+            drive.runShortTest()
+
+        poller = DrivePoller(drives, JobScheduler())
+        iterationTimes = list()
+        queriesCompleted = 0
+        lastRefresh = time.time()
+        loopStart = time.time()
+        while time.time() - loopStart < durationSecs:
+            iterationStart = time.time()
+
+            # Periodically re-query every drive, as mdm's auto-refresh does.
+            if iterationStart - lastRefresh > refreshSecs:
+                for drive in drives:
+                    drive.initiateQuery()
+                lastRefresh = iterationStart
+
+            # Finish queries that are done, reap child processes and advance jobs, as mdm does each frame.
+            queriedDrives, _ = poller.step()
+            queriesCompleted += len(queriedDrives)
+
+            # With no terminal there's no input to wake for, so mdm's wait for input is just its timeout.
+            iterationTimes.append(time.time() - iterationStart)
+            time.sleep(poller.waitSecs())
+
+        # Let outstanding queries finish so their CPU time is counted.
+        for drive in drives:
+            drive.waitForQuery()
+        elapsed = time.time() - startTime
+        cpuEnd = os.times()
+        cpuSecs = sum(cpuEnd[i] - cpuStart[i] for i in range(4))  # User and system time, own and children's.
+        loopElapsed = time.time() - loopStart
+
+        return {
+            "drives": driveCount,
+            "iterationMeanMs": 1000.0 * sum(iterationTimes) / max(len(iterationTimes), 1),
+            "iterationP99Ms": 1000.0 * percentile(iterationTimes, 0.99),
+            "iterationMaxMs": 1000.0 * max(iterationTimes) if len(iterationTimes) > 0 else 0.0,
+            "cpuPercent": 100.0 * cpuSecs / elapsed,
+            "queriesPerSec": queriesCompleted / loopElapsed,
+        }
+    finally:
+        shutil.rmtree(fleetDir, ignore_errors=True)
+
+
+# Format load test results as a table.
+def formatResults(resultsList):
+    lines = ["Drives  Iter mean ms  Iter p99 ms  Iter max ms  CPU %   Queries/s"]
+    for results in resultsList:
+        lines.append("%6d  %12.2f  %11.2f  %11.2f  %6.1f  %9.1f" % (
+            results["drives"], results["iterationMeanMs"], results["iterationP99Ms"], results["iterationMaxMs"],
+            results["cpuPercent"], results["queriesPerSec"]))
+    return '\n'.join(lines)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+# Export drive health and test progress as Prometheus metrics in a text file (for node_exporter's textfile
+#   collector). The file is replaced by atomic rename so a scrape never sees it half written. Only what the Drive
+#   objects already parsed is exported; nothing here runs smartctl. The sample lines of each drive are cached and
+#   only rebuilt for drives with a new snapshot since the last write, and the file isn't rewritten if nothing
+#   changed.
+import os
+import time
+
+from Drive import *
+
+METRIC_PREFIX = "mdm_drive_"
+
+# Exported metrics: (name, type, help text, function returning the value for a drive snapshot or None if it has
+#   none).
+METRICS = [
+    ("reallocated_sectors", "gauge", "Reallocated sector count (SMART attribute 5).",
+     lambda snapshot: snapshot.reallocCount if snapshot.reallocCount != NOT_INITIALIZED else None),
+    ("pending_sectors", "gauge", "Current pending sector count (SMART attribute 197).",
+     lambda snapshot: snapshot.pendingCount if snapshot.pendingCount != NOT_INITIALIZED else None),
+    ("uncorrectable_sectors", "gauge", "Offline uncorrectable sector count (SMART attribute 198).",
+     lambda snapshot: snapshot.uncorrectableCount if snapshot.uncorrectableCount != NOT_INITIALIZED else None),
+    ("power_on_hours", "gauge", "Power-on hours (SMART attribute 9).",
+     lambda snapshot: snapshot.hours if snapshot.hours != NOT_INITIALIZED else None),
+    ("gsense_errors", "gauge", "G-sense error rate raw value (SMART attribute 191 or 221).",
+     lambda snapshot: firstNumber(snapshot.GSenseCount)),
+    ("smart_status_code", "gauge", "SMART self-test execution status code.",
+     lambda snapshot: snapshot.smartStatusCode if snapshot.smartStatusCode >= 0 else None),
+    ("test_percent_remaining", "gauge", "Percentage of the running self-test left to do.",
+     lambda snapshot: 100 - snapshot.testPercentage if snapshot.state == DR_STATE_TESTING and
+     snapshot.testPercentage != NOT_INITIALIZED else None),
+    ("test_eta_timestamp_seconds", "gauge", "Predicted completion time of the running self-test (Unix time).",
+     lambda snapshot: time.mktime(snapshot.estimatedCompletionTime.timetuple())
+     if snapshot.state == DR_STATE_TESTING and snapshot.estimatedCompletionTime else None),
+    ("testing", "gauge", "1 if the drive is running a self-test.",
+     lambda snapshot: 1 if snapshot.state == DR_STATE_TESTING else 0),
+    ("standby", "gauge", "1 if the drive was spun down at its last query (and left that way).",
+     lambda snapshot: 1 if snapshot.state == DR_STATE_STANDBY else 0),
+    ("last_query_seconds", "gauge", "Time the most recent smartctl query took.",
+     lambda snapshot: snapshot.lastQueryLatency),
+    ("query_failures_total", "counter", "Number of smartctl queries that timed out or failed to open the drive.",
+     lambda snapshot: snapshot.queryFailures),
+]
+
+
+# Escape a label value as the Prometheus text format requires.
+def escapeLabel(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def formatValue(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# Sample lines of every metric for a snapshot of a drive, one list per metric (empty where it has no value).
+def driveSamples(devicePath, snapshot):
+    labels = '{path="%s",serial="%s",model="%s"}' % (escapeLabel(devicePath), escapeLabel(snapshot.serial),
+                                                     escapeLabel(snapshot.model))
+    samples = list()
+    for name, _, _, valueOf in METRICS:
+        value = valueOf(snapshot)
+        samples.append([] if value is None else [METRIC_PREFIX + name + labels + " " + formatValue(value)])
+    return samples
+
+
+class MetricsExporter(object):
+    def __init__(self, path):
+        self.path = path
+        self.cache = dict()  # Snapshot and samples of each drive, by device path.
+        self.lastPaths = None  # Device paths exported by the last write.
+
+    # Write the metrics file for a list of drives if anything changed. Returns the number of drives rebuilt.
+    def write(self, drives):
+        rebuilt = 0
+        for drive in drives:
+            snapshot = drive.snapshot  # Any change to a drive publishes a new snapshot.
+            cached = self.cache.get(drive.devicePath)
+            if cached is None or cached[0] is not snapshot:
+                self.cache[drive.devicePath] = (snapshot, driveSamples(drive.devicePath, snapshot))
+                rebuilt += 1
+        paths = [drive.devicePath for drive in drives]
+        if rebuilt == 0 and paths == self.lastPaths:
+            return 0
+        for devicePath in set(self.cache) - set(paths):
+            del self.cache[devicePath]  # Forget drives that have gone.
+
+        # Group the samples by metric, as the text format requires.
+        lines = list()
+        for i, (name, metricType, helpText, _) in enumerate(METRICS):
+            lines.append("# HELP " + METRIC_PREFIX + name + " " + helpText)
+            lines.append("# TYPE " + METRIC_PREFIX + name + " " + metricType)
+            for devicePath in paths:
+                lines.extend(self.cache[devicePath][1][i])
+        writeFileAtomically(self.path, '\n'.join(lines) + '\n')
+        self.lastPaths = paths
+        return rebuilt
+
+
+# Replace a file's contents by writing a temporary file beside it and renaming it over the original.
+def writeFileAtomically(path, text):
+    temporaryPath = path + ".%d.tmp" % os.getpid()  # Doesn't end in .prom, so the collector ignores it.
+    with open(temporaryPath, 'w') as temporaryFile:
+        temporaryFile.write(text)
+        temporaryFile.flush()
+        os.fsync(temporaryFile.fileno())
+    os.rename(temporaryPath, path)
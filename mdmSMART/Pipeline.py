@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+
+# Multi-stage per-drive jobs (eg, long test, then wipe if it passed, then verify the wipe) and a scheduler that
+#   runs them without letting bandwidth-heavy stages saturate a shared controller, USB hub or expander.
+import os
+import re
+import sys
+import tempfile
+import time
+
+from Drive import *
+from BulkIO import readProgress, BULK_PASSED
+from Topology import busOf, BUS_LIMITS
+from SpanTest import SpanRecord, spanRange, SPAN_COUNT, SPAN_PASSED, SPAN_FAILED
+
+# Path of the bulk I/O helper program that runs wipes, verifies and imaging.
+MDMIO_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "mdmio")
+PROGRESS_DIR = "/var/tmp/mdm"  # Where bulk I/O helpers write their progress files.
+IMAGE_DIR = os.environ.get("MDM_IMAGE_DIR", "/var/tmp/mdm/images")  # Where drive images (and their maps) go.
+
+TEST_POLL_INTERVAL_SECS = 30  # Time between smartctl queries while waiting for a self-test to finish.
+
+# Possible results of polling a stage.
+STAGE_RUNNING, STAGE_PASSED, STAGE_FAILED = range(3)
+
+# Possible states of a job.
+JOB_WAITING, JOB_RUNNING, JOB_PASSED, JOB_FAILED, JOB_CANCELLED = range(5)
+
+
+# A step of a job. Stages that move a lot of data over the bus set usesBus so the scheduler can limit them.
+class Stage(object):
+    name = "Stage"
+    usesBus = False
+
+    def __init__(self):
+        self.message = ""  # Short progress or outcome description, eg "45%".
+
+    # Begin the stage on a job's drive.
+    def start(self, job):
+        pass
+
+    # Check on the stage, returning one of the STAGE_ codes.
+    def poll(self, job):
+        return STAGE_PASSED
+
+    # Stop the stage early.
+    def cancel(self, job):
+        pass
+
+    # Estimated time until the stage finishes as a short string, or "" if there's no estimate.
+    def timeRemaining(self):
+        return ""
+
+
+# Run a SMART long self-test and wait for its result.
+class LongTestStage(Stage):
+    name = "Long test"
+
+    def start(self, job):
+        self.sawTesting = False  # Whether the drive has been seen testing since the stage started.
+        self.alreadyTesting = job.drive.state == DR_STATE_TESTING  # Another test is running: no long test starts.
+        self.historyBefore = job.drive.testHistory  # Test log from before the test.
+        self.lastQuery = time.time()
+        job.drive.runLongTest()
+
+    def poll(self, job):
+        drive = job.drive
+        if not drive.smartCapable:
+            self.message = "no SMART"
+            return STAGE_FAILED
+        if self.alreadyTesting:
+            self.message = "already testing"
+            return STAGE_FAILED
+        if drive.state == DR_STATE_QUERYING:
+            return STAGE_RUNNING
+        if drive.state == DR_STATE_TIMEOUT:
+            self.message = "timed out"
+            return STAGE_FAILED
+
+        # A drive that has spun down answers with what was known before the test: wake it for a full read.
+        if drive.state == DR_STATE_STANDBY:
+            drive.initiateQuery(wake=True)
+            return STAGE_RUNNING
+
+        # While testing, query the drive now and then to see its progress.
+        if drive.state == DR_STATE_TESTING:
+            self.sawTesting = True
+            if drive.testPercentage is not NOT_INITIALIZED:
+                self.message = str(drive.testPercentage) + "%"
+            if time.time() - self.lastQuery > TEST_POLL_INTERVAL_SECS:
+                drive.initiateQuery()
+                self.lastQuery = time.time()
+            return STAGE_RUNNING
+
+        # The drive has stopped testing and was read in full since the test started. The newest test log entry is
+        #   this test's result if the log is newer than before the test (or the test was seen running: a full log
+        #   can gain an entry identical to the rest), and unless the test that ran was another kind (eg, a short
+        #   test started while the stage was starting).
+        newLog = self.sawTesting or drive.testHistory != self.historyBefore
+        if not newLog or len(drive.testHistory) == 0 or "Extended offline" not in drive.testHistory[0]:
+            self.message = "didn't start"
+            return STAGE_FAILED
+        if "Completed without error" in drive.testHistory[0]:
+            return STAGE_PASSED
+        self.message = "failed"
+        return STAGE_FAILED
+
+    def cancel(self, job):
+        if job.drive.state == DR_STATE_TESTING:
+            job.drive.abortTest()
+
+
+# Self-test the drive span by span (see SpanTest), resuming from the first span that hasn't passed in an earlier
+#   run, and failing as soon as a span fails.
+class SpanTestStage(Stage):
+    name = "Span test"
+
+    def start(self, job):
+        drive = job.drive
+        self.record = None
+        self.span = None  # Index of the span being tested.
+        self.startTime = time.time()
+        self.spansDone = 0  # Spans passed in this run.
+        if drive.smartCapable and drive.serial and drive.lbaCount > 0:
+            self.record = SpanRecord(drive.serial, drive.lbaCount)
+            self.startNextSpan(job)
+
+    def startNextSpan(self, job):
+        self.span = self.record.nextSpan()
+        self.sawTesting = False  # Whether the drive has been seen testing since the span started.
+        self.historyBefore = job.drive.testHistory  # Test log from before the span.
+        self.began = False  # Whether the drive reported that the span's test began.
+        self.lastQuery = time.time()
+        if self.span is not None:
+            self.began = job.drive.runSelectiveTest(*spanRange(job.drive.lbaCount, self.span))
+
+    def poll(self, job):
+        drive = job.drive
+        if self.record is None:
+            self.message = "no SMART" if not drive.smartCapable else "size unknown"
+            return STAGE_FAILED
+        if self.span is None:
+            return STAGE_PASSED
+        if drive.state == DR_STATE_QUERYING:
+            return STAGE_RUNNING
+        if drive.state == DR_STATE_TIMEOUT:
+            self.message = "timed out"
+            return STAGE_FAILED
+
+        # A drive that has spun down answers with what was known before the span: wake it for a full read.
+        if drive.state == DR_STATE_STANDBY:
+            drive.initiateQuery(wake=True)
+            return STAGE_RUNNING
+
+        # While testing, query the drive now and then to see its progress.
+        if drive.state == DR_STATE_TESTING:
+            self.sawTesting = True
+            self.message = "%d/%d" % (self.record.passedCount(), SPAN_COUNT)
+            if drive.testPercentage is not NOT_INITIALIZED:
+                self.message += " " + str(drive.testPercentage) + "%"
+            if time.time() - self.lastQuery > TEST_POLL_INTERVAL_SECS:
+                drive.initiateQuery()
+                self.lastQuery = time.time()
+            return STAGE_RUNNING
+
+        # The drive has stopped testing and was read in full since the span started. The newest test log entry is
+        #   this span's result only if the selective self-test log holds the span's range, the test log is newer
+        #   than before the span (or the span was reported begun or seen running: a full log can gain an entry
+        #   identical to the rest), and the entry is a selective test's (any other test that ran, eg a short test
+        #   started by hand, says nothing about the span). Results are kept for good, so anything less records
+        #   nothing.
+        if len(drive.testHistory) == 0:
+            self.message = "no test log"
+            return STAGE_FAILED
+        result = drive.testHistory[0]
+        newLog = self.began or self.sawTesting or drive.testHistory != self.historyBefore
+        if drive.selectiveSpan != spanRange(drive.lbaCount, self.span) or not newLog or \
+                "Selective offline" not in result:
+            self.message = "didn't start"
+            return STAGE_FAILED
+        if "Completed without error" in result:
+            self.record.setResult(self.span, SPAN_PASSED)
+            self.spansDone += 1
+            self.startNextSpan(job)
+            return STAGE_RUNNING if self.span is not None else STAGE_PASSED
+        if "Completed" in result:
+            self.record.setResult(self.span, SPAN_FAILED)
+            self.message = "span %d failed" % (self.span + 1)
+        else:
+            self.message = "interrupted"  # Aborted or interrupted; a new run carries on from this span.
+        return STAGE_FAILED
+
+    def cancel(self, job):
+        if job.drive.state == DR_STATE_TESTING:
+            job.drive.abortTest()
+
+    # Spans left at the average rate of this run so far.
+    def timeRemaining(self):
+        if self.record is None or self.spansDone == 0:
+            return ""
+        spansLeft = SPAN_COUNT - self.record.passedCount()
+        return durationString((time.time() - self.startTime) / self.spansDone * spansLeft)
+
+
+# Decide from the drive's SMART data whether it's healthy enough to continue.
+class EvaluateStage(Stage):
+    name = "Evaluate"
+
+    def poll(self, job):
+        drive = job.drive
+        if drive.hasFailureHistory():
+            self.message = "bad test"
+        elif drive.reallocCount > 0:
+            self.message = "realloc"
+        elif drive.hasFailedAttributes():
+            self.message = "bad value"
+        else:
+            return STAGE_PASSED
+        return STAGE_FAILED
+
+
+# Run an mdmio operation on the drive in a child process and follow its progress file.
+class BulkIOStage(Stage):
+    name = "Bulk I/O"
+    usesBus = True
+    operation = None  # The mdmio operation to run.
+
+    def start(self, job):
+        if not os.path.isdir(PROGRESS_DIR):
+            os.makedirs(PROGRESS_DIR)
+        fd, self.progressPath = tempfile.mkstemp(prefix=os.path.basename(job.drive.devicePath) + ".",
+                                                 suffix=".progress", dir=PROGRESS_DIR)
+        os.close(fd)
+        self.firstProgress = None  # Time and bytes done at the first progress report, for working out the rate.
+        self.remainingSecs = None
+        command = [sys.executable, MDMIO_PATH, self.operation, job.drive.devicePath, "--progress", self.progressPath]
+        command += self.options(job)
+        self.process = supervisor.spawn(command, key=job.drive.devicePath + " bulk", captureOutput=False)
+
+    # Extra mdmio arguments for a job's drive.
+    def options(self, job):
+        if job.drive.model:
+            return ["--tune", "--model", job.drive.model]  # Tuning results are cached per model.
+        return ["--tune"]
+
+    def poll(self, job):
+        progress = readProgress(self.progressPath)
+        if progress is not None and progress[1] > 0:
+            bytesDone, bytesTotal = progress
+            self.message = str(bytesDone * 100 // bytesTotal) + "%"
+            if self.firstProgress is None:
+                self.firstProgress = (time.time(), bytesDone)
+            elapsed = time.time() - self.firstProgress[0]
+            if elapsed > 0 and bytesDone > self.firstProgress[1]:
+                bytesPerSec = (bytesDone - self.firstProgress[1]) / elapsed
+                self.message += " " + rateString(bytesPerSec)
+                self.remainingSecs = (bytesTotal - bytesDone) / bytesPerSec
+        if self.process.poll() == PROC_RUNNING:
+            return STAGE_RUNNING
+        self.removeProgressFile()
+        if self.process.status == PROC_DONE and self.process.returnCode == BULK_PASSED:
+            return STAGE_PASSED
+        self.message = "failed"
+        return STAGE_FAILED
+
+    def cancel(self, job):
+        supervisor.stop(self.process)
+        self.removeProgressFile()
+
+    def timeRemaining(self):
+        return durationString(self.remainingSecs) if self.remainingSecs is not None else ""
+
+    def removeProgressFile(self):
+        if os.path.exists(self.progressPath):
+            os.remove(self.progressPath)
+
+
+class WipeStage(BulkIOStage):
+    name = "Wipe"
+    operation = "wipe"
+
+    # Discard SSDs rather than overwriting them: it takes minutes rather than hours and doesn't wear the flash.
+    def options(self, job):
+        options = BulkIOStage.options(self, job)
+        return options + ["--discard"] if job.drive.rotationRate == "SSD" else options
+
+
+class VerifyStage(BulkIOStage):
+    name = "Verify"
+    operation = "verify"
+
+
+# Copy the drive to a sparse image file in IMAGE_DIR, named after its model and serial number. Running it again
+#   for the same drive resumes an interrupted image and retries unreadable sectors.
+class ImageStage(BulkIOStage):
+    name = "Image"
+    operation = "image"
+
+    def options(self, job):
+        if not os.path.isdir(IMAGE_DIR):
+            os.makedirs(IMAGE_DIR)
+        return ["--output", imagePathFor(job.drive)]
+
+
+# Path of a drive's image file.
+def imagePathFor(drive):
+    name = drive.model + "_" + drive.serial if drive.serial else os.path.basename(drive.devicePath)
+    return os.path.join(IMAGE_DIR, re.sub(r"[^\w.-]", "_", name) + ".img")
+
+
+# Ready-made pipelines, as lists of stage classes.
+PIPELINE_TEST_THEN_WIPE = [LongTestStage, EvaluateStage, WipeStage, VerifyStage]
+PIPELINE_WIPE = [WipeStage, VerifyStage]
+PIPELINE_IMAGE = [ImageStage]
+PIPELINE_SPAN_TEST = [SpanTestStage]
+
+
+# A pipeline of stages being run on one drive.
+class Job(object):
+    def __init__(self, drive, stageClasses):
+        self.drive = drive
+        self.stages = [stageClass() for stageClass in stageClasses]
+        self.stageIndex = 0
+        self.state = JOB_WAITING  # Waiting means the current stage hasn't started.
+        self.busType, self.busKey = busOf(drive.devicePath)
+
+    def currentStage(self):
+        return self.stages[self.stageIndex]
+
+    def isFinished(self):
+        return self.state in [JOB_PASSED, JOB_FAILED, JOB_CANCELLED]
+
+    # Describe the job in a few characters for the drive table.
+    def statusString(self):
+        stage = self.currentStage()
+        if self.state == JOB_WAITING:
+            return stage.name + " queued"
+        elif self.state == JOB_RUNNING:
+            return (stage.name + " " + stage.message).strip()
+        elif self.state == JOB_PASSED:
+            return "Job passed"
+        elif self.state == JOB_FAILED:
+            return (stage.name + " " + (stage.message or "failed")).strip()
+        else:
+            return "Job cancelled"
+
+    # Estimated time until the running stage finishes, or "".
+    def timeRemaining(self):
+        return self.currentStage().timeRemaining() if self.state == JOB_RUNNING else ""
+
+
+# Runs jobs for many drives, starting each stage as soon as its drive (and, for bus stages, its link) is free.
+class JobScheduler(object):
+    def __init__(self, busLimits=BUS_LIMITS):
+        self.busLimits = busLimits
+        self.jobs = dict()  # Most recent job of each drive, by device path.
+
+    # Start a pipeline on a drive unless the drive already has one running.
+    def addJob(self, drive, stageClasses):
+        job = self.jobs.get(drive.devicePath)
+        if job is not None and not job.isFinished():
+            return False
+        self.jobs[drive.devicePath] = Job(drive, stageClasses)
+        return True
+
+    def jobFor(self, drive):
+        return self.jobs.get(drive.devicePath)
+
+    def cancelJob(self, drive):
+        job = self.jobs.get(drive.devicePath)
+        if job is not None and not job.isFinished():
+            if job.state == JOB_RUNNING:
+                job.currentStage().cancel(job)
+            job.state = JOB_CANCELLED
+
+    def hasActiveJobs(self):
+        return any(not job.isFinished() for job in self.jobs.values())
+
+    # Advance every job as far as it can go. Returns True if anything visible changed.
+    def update(self):
+        changed = False
+        activeJobs = [job for job in self.jobs.values() if not job.isFinished()]
+
+        # Count the bus stages already running on each link.
+        busLoad = dict()
+        for job in activeJobs:
+            if job.state == JOB_RUNNING and job.currentStage().usesBus:
+                busLoad[job.busKey] = busLoad.get(job.busKey, 0) + 1
+
+        # Poll running stages first so that any link they free up can be used straight away.
+        for job in sorted(activeJobs, key=lambda j: j.drive.devicePath):
+            if job.state != JOB_RUNNING:
+                continue
+            stage = job.currentStage()
+            oldMessage = stage.message
+            result = stage.poll(job)
+            changed = changed or stage.message != oldMessage
+            if result == STAGE_RUNNING:
+                continue
+            if stage.usesBus:
+                busLoad[job.busKey] -= 1
+            if result == STAGE_FAILED:
+                job.state = JOB_FAILED
+            elif job.stageIndex + 1 < len(job.stages):
+                job.stageIndex += 1
+                job.state = JOB_WAITING
+            else:
+                job.state = JOB_PASSED
+            changed = True
+
+        # Start waiting stages whose link has room.
+        for job in sorted(activeJobs, key=lambda j: j.drive.devicePath):
+            if job.state != JOB_WAITING:
+                continue
+            stage = job.currentStage()
+            if stage.usesBus:
+                if busLoad.get(job.busKey, 0) >= self.busLimits[job.busType]:
+                    continue
+                busLoad[job.busKey] = busLoad.get(job.busKey, 0) + 1
+            stage.start(job)
+            job.state = JOB_RUNNING
+            changed = True
+
+        return changed
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+
+# The per-frame drive work of mdm's main loop, shared with the collector process and the load test so they all
+#   run (and the load test measures) the same code. Each frame finishes the queries that are done, kills child
+#   processes that overran their deadlines and reaps finished ones, and advances batch jobs now and then. Between
+#   frames the caller waits for input for waitSecs(): briefly while anything is in progress, longer otherwise.
+import time
+
+from Drive import *
+
+JOB_UPDATE_INTERVAL_SECS = 0.5  # Time between checks on the progress of batch jobs.
+BUSY_WAIT_SECS = 0.01  # Longest wait for input while queries or jobs are in progress.
+IDLE_WAIT_SECS = 0.25  # Longest wait for input while nothing else is happening.
+
+
+class DrivePoller(object):
+    def __init__(self, drives, jobScheduler):
+        self.drives = drives  # Shared with the caller, which may add or remove drives.
+        self.jobScheduler = jobScheduler
+        self.lastJobUpdate = 0  # Time of the last job progress check.
+
+    # Do one frame's work. Returns the drives whose queries finished and whether any job changed.
+    def step(self):
+        queriedDrives = [drive for drive in self.drives if drive.state == DR_STATE_QUERYING and drive.queryIsDone()]
+        supervisor.reap()
+        jobsChanged = False
+        if time.time() - self.lastJobUpdate > JOB_UPDATE_INTERVAL_SECS:
+            jobsChanged = self.jobScheduler.update()
+            self.lastJobUpdate = time.time()
+        return queriedDrives, jobsChanged
+
+    # Longest time to wait for input before the next frame.
+    def waitSecs(self):
+        if any(drive.state == DR_STATE_QUERYING for drive in self.drives) or self.jobScheduler.hasActiveJobs():
+            return BUSY_WAIT_SECS
+        return IDLE_WAIT_SECS
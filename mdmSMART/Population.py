@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+# Population analysis of saved smartctl output, along the lines of Google's "Failure Trends in a Large Disk
+#   Population" paper. A directory tree of "smartctl -a" dumps is parsed in parallel by a pool of worker processes
+#   with the Drive parser (smartctl is never run). Each worker hands back its share of the dumps as NumPy arrays,
+#   which are joined into one column per field, and failure rates are worked out with vectorized operations.
+#   A dump counts as a failed drive if the drive failed its overall-health assessment or a self-test, or has an
+#   attribute with a WHEN_FAILED entry.
+import multiprocessing
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Only needed for ingestion and analysis; mdmingest reports its absence.
+
+from Drive import *
+
+CHUNK_SIZE = 256  # Dumps parsed per worker task.
+MAX_DUMP_BYTES = 1 << 20  # Read no more than this much of any file (smartctl output is a few KB).
+MISSING = NOT_INITIALIZED  # Value of fields and attributes a dump doesn't have.
+DUMP_MARKER = "=== START OF INFORMATION SECTION ==="  # Text that every "smartctl -a" dump contains.
+
+# Numeric fields taken from every dump, in column order.
+FIELDS = ["hours", "realloc", "pending", "uncorrectable", "statusCode", "failed"]
+
+# Bin edges (lower bounds) for failure rate tables.
+REALLOC_EDGES = [0, 1, 2, 5, 10, 100, 1000]
+SCAN_ERROR_EDGES = [0, 1, 2, 10, 100]
+HOURS_EDGES = [0, 2190, 4383, 8766, 17532, 26298, 35064, 43830]  # 0, 3 and 6 months, then 1 to 5 years.
+
+
+# List every file under a directory, in a stable order.
+def findDumps(root):
+    paths = list()
+    for directory, _, fileNames in os.walk(root):
+        paths.extend(os.path.join(directory, fileName) for fileName in fileNames)
+    return sorted(paths)
+
+
+# Numeric fields of a parsed dump, in FIELDS order.
+def dumpFields(drive):
+    health = capture(r"overall-health self-assessment test result:\s*(\S+)", drive.smartctlOutput)
+    failed = health == "FAILED" or drive.hasFailureHistory() or drive.hasFailedAttributes()
+    return [drive.hours, drive.reallocCount, drive.pendingCount, drive.uncorrectableCount, drive.smartStatusCode,
+            int(failed)]
+
+
+# Worker task: parse a list of dump files. Returns (paths, models, serials, fields, attribute IDs, attributes),
+#   where fields has a row per dump and a column per FIELDS entry, and attributes has a row per dump and a column
+#   of raw values per attribute ID seen in the chunk. Files that aren't smartctl dumps are left out.
+def parseChunk(paths):
+    keptPaths, models, serials, fields, rawValues = list(), list(), list(), list(), list()
+    for path in paths:
+        try:
+            with open(path) as dumpFile:
+                text = dumpFile.read(MAX_DUMP_BYTES)
+        except IOError:
+            continue
+        if DUMP_MARKER not in text:
+            continue
+        drive = Drive(path, smartctlOutput=text)
+        keptPaths.append(path)
+        models.append(drive.model)
+        serials.append(drive.serial)
+        fields.append(dumpFields(drive))
+        rawValues.append(dict((attribute.idNumber, firstNumber(attribute.rawValue))
+                              for attribute in drive.attributes if attribute))
+
+    attributeIds = sorted(set(idNumber for values in rawValues for idNumber in values))
+    columnOf = dict((idNumber, column) for column, idNumber in enumerate(attributeIds))
+    attributes = numpy.full((len(keptPaths), len(attributeIds)), MISSING, numpy.int64)
+    for row, values in enumerate(rawValues):
+        for idNumber, value in values.items():
+            if value is not None:
+                attributes[row, columnOf[idNumber]] = value
+    return (keptPaths, models, serials, numpy.array(fields, numpy.int64).reshape(-1, len(FIELDS)),
+            numpy.array(attributeIds, numpy.int64), attributes)
+
+
+# Parsed dumps held as columns.
+class Population(object):
+    def __init__(self, paths, models, serials, fields, attributeIds, attributes):
+        self.paths = paths
+        self.serials = serials
+        self.modelNames, self.modelCodes = numpy.unique(models, return_inverse=True)  # Dictionary-encoded models.
+        self.fields = dict((name, fields[:, i]) for i, name in enumerate(FIELDS))
+        self.failed = self.fields["failed"].astype(bool)
+        self.attributeIds = attributeIds
+        self.attributes = attributes  # A row per dump, a column per attribute ID.
+
+    def __len__(self):
+        return len(self.paths)
+
+    # Raw values of one attribute for every dump (MISSING where a dump doesn't have it).
+    def attribute(self, idNumber):
+        column = numpy.searchsorted(self.attributeIds, idNumber)
+        if column < len(self.attributeIds) and self.attributeIds[column] == idNumber:
+            return self.attributes[:, column]
+        return numpy.full(len(self), MISSING, numpy.int64)
+
+    # Indexes of the newest dump (most power-on hours) of each serial number, so drives dumped at several intakes
+    #   are counted once. Dumps without a serial number can't be told apart from each other, so they're left out.
+    def latestPerDrive(self):
+        serialNames, serialCodes = numpy.unique(self.serials, return_inverse=True)
+        order = numpy.lexsort((self.fields["hours"], serialCodes))
+        isLast = numpy.append(serialCodes[order][1:] != serialCodes[order][:-1], True)
+        latest = order[isLast]
+        return numpy.sort(latest[serialNames[serialCodes[latest]] != ""])
+
+    # A population of a subset of the dumps, given their indexes.
+    def subset(self, indexes):
+        fields = numpy.column_stack([self.fields[name][indexes] for name in FIELDS])
+        return Population([self.paths[i] for i in indexes], self.modelNames[self.modelCodes[indexes]],
+                          [self.serials[i] for i in indexes], fields, self.attributeIds, self.attributes[indexes])
+
+
+# Parse dump files in parallel and return them as a Population.
+def ingest(paths, processes=None):
+    chunks = [paths[i:i + CHUNK_SIZE] for i in range(0, len(paths), CHUNK_SIZE)]
+    if processes == 1:
+        results = [parseChunk(chunk) for chunk in chunks]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(parseChunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+
+    # Join the chunks, spreading each chunk's attribute columns into the columns of all attribute IDs seen.
+    attributeIds = numpy.unique(numpy.concatenate([result[4] for result in results] + [numpy.zeros(0, numpy.int64)]))
+    rowCount = sum(len(result[0]) for result in results)
+    attributes = numpy.full((rowCount, len(attributeIds)), MISSING, numpy.int64)
+    paths, models, serials, fields = list(), list(), list(), list()
+    row = 0
+    for chunkPaths, chunkModels, chunkSerials, chunkFields, chunkIds, chunkAttributes in results:
+        attributes[row:row + len(chunkPaths), numpy.searchsorted(attributeIds, chunkIds)] = chunkAttributes
+        row += len(chunkPaths)
+        paths.extend(chunkPaths)
+        models.extend(chunkModels)
+        serials.extend(chunkSerials)
+        fields.append(chunkFields)
+    fields = numpy.concatenate(fields + [numpy.zeros((0, len(FIELDS)), numpy.int64)])
+    return Population(paths, numpy.array(models, dtype=object), serials, fields, attributeIds, attributes)
+
+
+# Labels for bins with the given lower bounds, eg [0, 1, 5] -> ["0", "1-4", "5+"].
+def binLabels(edges):
+    labels = list()
+    for i in range(len(edges)):
+        if i + 1 == len(edges):
+            labels.append(str(edges[i]) + "+")
+        elif edges[i + 1] - edges[i] == 1:
+            labels.append(str(edges[i]))
+        else:
+            labels.append(str(edges[i]) + "-" + str(edges[i + 1] - 1))
+    return labels
+
+
+# Failure rates of drives binned by a column of values. Returns rows of (label, drives, failures, rate).
+def failureRatesByBins(values, failed, edges):
+    known = values != MISSING
+    bins = numpy.digitize(values[known], edges) - 1
+    drives = numpy.bincount(bins, minlength=len(edges))
+    failures = numpy.bincount(bins, weights=failed[known], minlength=len(edges)).astype(numpy.int64)
+    rates = failures / numpy.maximum(drives, 1).astype(float)
+    return zip(binLabels(edges), drives, failures, rates)
+
+
+# Failure rates per model, largest model populations first. Returns rows of (model, drives, failures, rate).
+def failureRatesByModel(population, minDrives=1):
+    drives = numpy.bincount(population.modelCodes, minlength=len(population.modelNames))
+    failures = numpy.bincount(population.modelCodes, weights=population.failed,
+                              minlength=len(population.modelNames)).astype(numpy.int64)
+    rates = failures / numpy.maximum(drives, 1).astype(float)
+    order = numpy.argsort(-drives, kind="mergesort")
+    return [(population.modelNames[i] or "(unknown)", drives[i], failures[i], rates[i])
+            for i in order if drives[i] >= minDrives]
+
+
+# The standard set of failure rate tables, as (title, rows) pairs.
+def analyse(population, minModelDrives=1):
+    failed = population.failed
+    return [
+        ("Reallocated sectors (attribute 5)", failureRatesByBins(population.fields["realloc"], failed, REALLOC_EDGES)),
+        ("Pending sectors (attribute 197)", failureRatesByBins(population.fields["pending"], failed,
+                                                               SCAN_ERROR_EDGES)),
+        ("Offline uncorrectable sectors / scan errors (attribute 198)",
+         failureRatesByBins(population.fields["uncorrectable"], failed, SCAN_ERROR_EDGES)),
+        ("Power-on hours (attribute 9)", failureRatesByBins(population.fields["hours"], failed, HOURS_EDGES)),
+        ("Model", failureRatesByModel(population, minModelDrives)),
+    ]
+
+
+# Format failure rate tables as text.
+def formatReport(population, tables):
+    lines = ["%d drives, %d failed (%.1f%%)" % (len(population), population.failed.sum(),
+                                                 100.0 * population.failed.sum() / max(len(population), 1))]
+    for title, rows in tables:
+        lines.append("")
+        lines.append(title)
+        lines.append("  %-32s %8s %8s %7s" % ("", "Drives", "Failed", "Rate"))
+        for label, drives, failures, rate in rows:
+            lines.append("  %-32s %8d %8d %6.1f%%" % (str(label)[:32], drives, failures, 100.0 * rate))
+    return '\n'.join(lines)
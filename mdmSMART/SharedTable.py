@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# A table of fixed-layout records in shared memory, written by one process and read by others without locks.
+#   The memory is an anonymous shared mapping, so the table must be created before forking the processes that
+#   share it. Each record slot starts with a sequence counter (a seqlock): the writer makes it odd before changing
+#   the record and even again afterwards, and a reader copies the record between two reads of the counter and
+#   retries if the counter was odd or moved. Readers never block the writer, and a reader can tell which records
+#   have changed since it last looked by comparing counters.
+import mmap
+import struct
+
+SEQUENCE_FORMAT = "=I"
+SEQUENCE_SIZE = struct.calcsize(SEQUENCE_FORMAT)
+SEQUENCE_MASK = 0xffffffff
+READ_ATTEMPTS = 100  # Tries at getting a consistent copy of a record before giving up until the next read.
+
+
+class SharedTable(object):
+    def __init__(self, recordCount, recordFormat):
+        self.recordCount = recordCount
+        self.record = struct.Struct(recordFormat)
+        self.slotSize = SEQUENCE_SIZE + self.record.size
+        self.memory = mmap.mmap(-1, max(recordCount, 1) * self.slotSize)  # Anonymous mappings are shared on fork.
+        self.published = [None] * recordCount  # Writer's copy of the last values written to each record.
+
+    # Current sequence counter of a record. Odd while the record is being written.
+    def sequence(self, index):
+        return struct.unpack_from(SEQUENCE_FORMAT, self.memory, index * self.slotSize)[0]
+
+    # Write a record (a tuple of values matching the record format). Returns False if it was already up to date.
+    def write(self, index, values):
+        if values == self.published[index]:
+            return False
+        offset = index * self.slotSize
+        sequence = self.sequence(index)
+        struct.pack_into(SEQUENCE_FORMAT, self.memory, offset, (sequence + 1) & SEQUENCE_MASK)
+        self.record.pack_into(self.memory, offset + SEQUENCE_SIZE, *values)
+        struct.pack_into(SEQUENCE_FORMAT, self.memory, offset, (sequence + 2) & SEQUENCE_MASK)
+        self.published[index] = values
+        return True
+
+    # Read a record, returning (sequence, values), or (None, None) if the writer kept changing it.
+    def read(self, index):
+        offset = index * self.slotSize
+        for attempt in range(READ_ATTEMPTS):
+            before = self.sequence(index)
+            if before % 2 == 1:
+                continue
+            values = self.record.unpack_from(self.memory, offset + SEQUENCE_SIZE)
+            if self.sequence(index) == before:
+                return before, values
+        return None, None
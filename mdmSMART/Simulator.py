@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# A simulated fleet of drives for testing MDM without hardware.
+#   A fleet is a directory holding fleet.json (clock and per-drive settings) and one state file per drive. The
+#   smartsim program stands in for smartctl: it answers each command from the recorded smartctl captures in
+#   "hard drive output examples", stepping every drive through idle -> testing -> completed (or failed/aborted)
+#   on an accelerated clock, with optional latency, hangs and failures injected per drive. Idle drives can spin down
+#   into standby, where "-n standby" leaves them be and any other command wakes them (slowly). Selective self-tests
+#   of LBA spans take their share of the long test time, and fail if they cover a drive's bad sector (if it has
+#   one).
+import datetime
+import glob
+import json
+import math
+import os
+import random
+import re
+import sys
+import time
+
+# Directory of recorded smartctl output that the simulated drives are modelled on.
+CAPTURE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "hard drive output examples")
+
+# Recorded responses of a Fujitsu drive to test commands.
+CAPTURE_SHORT_START = "fuj2_start"
+CAPTURE_LONG_START = "fuj7_start_long"
+CAPTURE_ALREADY_TESTING = "fuj4_attempt_while_running"
+
+FLEET_FILE = "fleet.json"
+SIMULATOR_DIR_VARIABLE = "MDM_SIMULATOR_DIR"  # Environment variable that tells smartsim where its fleet is.
+SIMULATED_PATH_PREFIX = "/dev/sim"
+
+# Possible states of a simulated drive.
+SIM_IDLE, SIM_TESTING, SIM_ABORTED, SIM_READ_FAILURE = "idle", "testing", "aborted", "read failure"
+
+# Exit codes used by smartctl (a bit mask; bit 1 means the device could not be opened).
+EXIT_OK = 0
+EXIT_OPEN_FAILED = 2
+EXIT_STANDBY = 2  # What "-n standby" exits with when it finds the drive spun down.
+
+ETA_FORMAT = "%a %b %d %H:%M:%S %Y"  # Same format as smartctl's "Test will complete after" line.
+
+
+# Read a recorded capture by file name.
+def readCapture(name):
+    with open(os.path.join(CAPTURE_DIR, name)) as captureFile:
+        return captureFile.read()
+
+
+# Names of the full "smartctl -a" captures that can be used as templates for simulated drives.
+def templateCaptures():
+    names = list()
+    for path in sorted(glob.glob(os.path.join(CAPTURE_DIR, "*"))):
+        text = open(path).read()
+        if "Self-test execution status:" in text and "Vendor Specific SMART Attributes" in text:
+            names.append(os.path.basename(path))
+    return names
+
+
+# Number of logical sectors of a drive, from its capture (0 if the capture doesn't say).
+def lbaCountOf(capture):
+    capacity = re.search(r"User Capacity:\s*([\d,]+) bytes", capture)
+    sectorSize = re.search(r"Sector Sizes?:\s*(\d+) bytes logical", capture)
+    if capacity is None:
+        return 0
+    return int(capacity.group(1).replace(",", "")) // (int(sectorSize.group(1)) if sectorSize else 512)
+
+
+# Create a fleet directory of simulated drives and return their device paths.
+def createFleet(fleetDir, driveCount, timeScale=60.0, latencySecs=0.05, latencyJitterSecs=0.05, hangRate=0.0,
+                hangSecs=3600.0, failRate=0.0, testFailRate=0.0, standbyAfterSecs=None, spinUpSecs=5.0,
+                badSectorRate=0.0, seed=None):
+    generator = random.Random(seed)
+    templates = templateCaptures()
+    fleet = {"startTime": time.time(), "timeScale": timeScale, "drives": dict()}
+    for i in range(driveCount):
+        devicePath = SIMULATED_PATH_PREFIX + "%03d" % i
+        capture = templates[i % len(templates)]
+        badSectorLba = None
+        if generator.random() < badSectorRate:
+            badSectorLba = generator.randint(0, max(lbaCountOf(readCapture(capture)) - 1, 0))
+        fleet["drives"][devicePath] = {
+            "capture": capture,
+            "serial": "SIM%05d%04X" % (i, generator.randint(0, 0xffff)),
+            "latencySecs": latencySecs,
+            "latencyJitterSecs": latencyJitterSecs,
+            "hangRate": hangRate,
+            "hangSecs": hangSecs,
+            "failRate": failRate,
+            "testFailRate": testFailRate,
+            "standbyAfterSecs": standbyAfterSecs,  # Simulated idle time before spinning down (None: never).
+            "spinUpSecs": spinUpSecs,  # Real time a command takes when it has to wake the drive.
+            "badSectorLba": badSectorLba,  # Unreadable sector that fails any test covering it (None: no such).
+        }
+    if not os.path.isdir(fleetDir):
+        os.makedirs(fleetDir)
+    writeJson(os.path.join(fleetDir, FLEET_FILE), fleet)
+    return sorted(fleet["drives"].keys())
+
+
+# Write a JSON file atomically so concurrent smartsim processes never read a partial file.
+def writeJson(path, value):
+    temporaryPath = path + ".%d.tmp" % os.getpid()
+    with open(temporaryPath, 'w') as jsonFile:
+        json.dump(value, jsonFile)
+    os.rename(temporaryPath, path)
+
+
+def readJson(path, default=None):
+    try:
+        with open(path) as jsonFile:
+            return json.load(jsonFile)
+    except (IOError, ValueError):
+        return default
+
+
+class SimulatedDrive(object):
+    def __init__(self, fleetDir, fleet, devicePath):
+        self.fleet = fleet
+        self.settings = fleet["drives"][devicePath]
+        self.devicePath = devicePath
+        self.statePath = os.path.join(fleetDir, os.path.basename(devicePath) + ".state")
+        self.capture = readCapture(self.settings["capture"])
+        self.state = readJson(self.statePath, {"status": SIM_IDLE, "history": list(), "lastAccess": 0.0})
+        self.shortMinutes = self.pollingMinutes("Short")
+        self.longMinutes = self.pollingMinutes("Extended")
+
+    # Seconds of simulated time since the fleet was created.
+    def simulatedNow(self):
+        return (time.time() - self.fleet["startTime"]) * self.fleet["timeScale"]
+
+    # Read a recommended test duration (in minutes) from the template capture.
+    def pollingMinutes(self, testName):
+        match = re.search(testName + r" self-test routine\s*\n\s*recommended polling time:\s*\(\s*(\d+)\)",
+                          self.capture)
+        return int(match.group(1)) if match else 2
+
+    def save(self):
+        writeJson(self.statePath, self.state)
+
+    # Move a running test forward on the simulated clock, completing it if its time is up.
+    def advance(self):
+        if self.state["status"] != SIM_TESTING:
+            return
+        if self.simulatedNow() >= self.state["testStart"] + self.state["testDuration"]:
+            self.state["lastAccess"] = self.state["testStart"] + self.state["testDuration"]  # Busy until the end.
+            if self.state["testWillFail"]:
+                self.state["status"] = SIM_READ_FAILURE
+                self.logTest("Completed: read failure", 40, self.settings.get("badSectorLba") or "-")
+            else:
+                self.state["status"] = SIM_IDLE
+                self.logTest("Completed without error", 0)
+            self.save()
+
+    # Test whether the drive has been idle long enough to have spun down.
+    def isSpunDown(self):
+        standbyAfterSecs = self.settings.get("standbyAfterSecs")
+        if standbyAfterSecs is None or self.state["status"] == SIM_TESTING:
+            return False
+        return self.simulatedNow() - self.state.get("lastAccess", 0.0) > standbyAfterSecs
+
+    # Note that a command reached the drive (waking it if needed).
+    def touch(self):
+        self.state["lastAccess"] = self.simulatedNow()
+        self.save()
+
+    # Tenths of the running test still to do (9 .. 1).
+    def remainingTenths(self):
+        elapsed = self.simulatedNow() - self.state["testStart"]
+        fraction = 1.0 - elapsed / float(self.state["testDuration"])
+        return max(1, min(9, int(math.ceil(fraction * 10))))
+
+    def logTest(self, result, remainingPercent, firstErrorLba="-"):
+        self.state["history"].insert(0, [self.state["testType"], result, remainingPercent, firstErrorLba])
+
+    # Respond to "-t short", "-t long" or "-t select,FIRST-LAST".
+    def startTest(self, testType):
+        if self.state["status"] == SIM_TESTING:
+            return re.sub(r"\(\d+% remaining\)", "(%d0%% remaining)" % self.remainingTenths(),
+                          readCapture(CAPTURE_ALREADY_TESTING))
+        badSectorLba = self.settings.get("badSectorLba")
+        span = re.match(r"select,(\d+)-(\d+)$", testType)
+        if span:
+            firstLba, lastLba = int(span.group(1)), int(span.group(2))
+            share = (lastLba - firstLba + 1) / float(max(lbaCountOf(self.capture), 1))
+            minutes = max(self.longMinutes * share, 1.0 / 60)
+            description = "Selective offline"
+            coversBadSector = badSectorLba is not None and firstLba <= badSectorLba <= lastLba
+        else:
+            minutes = self.shortMinutes if testType == "short" else self.longMinutes
+            description = "Short offline" if testType == "short" else "Extended offline"
+            coversBadSector = badSectorLba is not None and testType != "short"
+        self.state.update({
+            "status": SIM_TESTING,
+            "testType": description,
+            "testStart": self.simulatedNow(),
+            "testDuration": minutes * 60.0,
+            "testWillFail": coversBadSector or random.random() < self.settings["testFailRate"],
+        })
+        if span:
+            self.state["selectiveSpan"] = [firstLba, lastLba]
+        self.save()
+        completion = datetime.datetime.now() + datetime.timedelta(seconds=minutes * 60.0 / self.fleet["timeScale"])
+        response = readCapture(CAPTURE_SHORT_START if testType == "short" else CAPTURE_LONG_START)
+        if span:
+            response = response.replace("Extended self-test", "Selective self-test")
+        response = re.sub(r"Please wait \d+ minutes", "Please wait %d minutes" % math.ceil(minutes), response)
+        return re.sub(r"Test will complete after .*", "Test will complete after " + completion.strftime(ETA_FORMAT),
+                      response)
+
+    # Respond to "-X".
+    def abortTest(self):
+        if self.state["status"] == SIM_TESTING:
+            self.state["status"] = SIM_ABORTED
+            self.logTest("Aborted by host", self.remainingTenths() * 10)
+            self.save()
+        return "=== START OF OFFLINE IMMEDIATE AND SELF-TEST SECTION ===\n" + \
+               "Sending command: \"Abort SMART off-line mode self-test routine\".\nSelf-testing aborted!\n"
+
+    # Respond to "-a" by rewriting the template capture to match the simulated state.
+    def allInformation(self):
+        text = re.sub(r"(Serial Number:\s*).*", r"\g<1>" + self.settings["serial"], self.capture)
+        text = re.sub(r"Self-test execution status:.*\n(\t+.*\n)*", self.executionStatusText(), text)
+        text = re.sub(r"(CURRENT_TEST_STATUS\s*\n)\s*1\s.*\n", r"\g<1>" + self.selectiveSpanText(), text)
+        return re.sub(r"SMART Self-test log structure.*\n(.+\n)*", self.selfTestLogText(), text)
+
+    def executionStatusText(self):
+        status = self.state["status"]
+        if status == SIM_TESTING:
+            tenths = self.remainingTenths()
+            code, lines = 240 + tenths, ["Self-test routine in progress...", "%d0%% of test remaining." % tenths]
+        elif status == SIM_ABORTED:
+            code, lines = 16, ["The self-test routine was aborted by", "the host."]
+        elif status == SIM_READ_FAILURE:
+            code, lines = 118, ["The previous self-test completed having", "the read element of the test failed."]
+        else:
+            code, lines = 0, ["The previous self-test routine completed", "without error or no self-test has ever ",
+                              "been run."]
+        return "Self-test execution status:      (%4d)\t" % code + "\n\t\t\t\t\t".join(lines) + "\n"
+
+    # First line of the selective self-test log's span table.
+    def selectiveSpanText(self):
+        firstLba, lastLba = self.state.get("selectiveSpan", [0, 0])
+        testing = self.state["status"] == SIM_TESTING and self.state["testType"] == "Selective offline"
+        return "%5d %8d %8d  %s\n" % (1, firstLba, lastLba, "Self_test_in_progress" if testing else "Not_testing")
+
+    # Build the self-test log from the simulated tests followed by the ones recorded in the template.
+    def selfTestLogText(self):
+        recorded = re.findall(r"^# ?\d+\s+(\S+ \S+)\s+(.*?)\s+(\d+)%\s+(\d+)\s+(\S+)\s*$", self.capture, re.MULTILINE)
+        hours = int(recorded[0][3]) if len(recorded) > 0 else 0
+        entries = [(entry[0], entry[1], entry[2], hours, entry[3] if len(entry) > 3 else "-")
+                   for entry in self.state["history"]]
+        entries += [(t, r, int(rem), int(h), lba) for t, r, rem, h, lba in recorded]
+        text = "SMART Self-test log structure revision number 1\n"
+        if len(entries) == 0:
+            return text + "No self-tests have been logged.  [To run self-tests, use: smartctl -t]\n"
+        text += "Num  Test_Description    Status                  Remaining  LifeTime(hours)  LBA_of_first_error\n"
+        for i in range(min(len(entries), 21)):  # The SMART log holds 21 entries.
+            text += "#%2d  %-20s%-30s%02d%%%10d%10s\n" % ((i + 1,) + tuple(entries[i]))
+        return text
+
+
+# Entry point of the smartsim program: behave like smartctl for a simulated drive.
+def smartctlMain(arguments):
+    fleetDir = os.environ.get(SIMULATOR_DIR_VARIABLE)
+    fleet = readJson(os.path.join(fleetDir, FLEET_FILE)) if fleetDir else None
+    if fleet is None:
+        sys.stderr.write("smartsim: set " + SIMULATOR_DIR_VARIABLE + " to a fleet directory.\n")
+        return EXIT_OPEN_FAILED
+
+    # Pick out the options smartctl is called with.
+    options = dict()
+    devicePath = None
+    i = 0
+    while i < len(arguments):
+        if arguments[i] in ["-s", "-t", "-n", "-l", "-d"] and i + 1 < len(arguments):
+            options[arguments[i]] = arguments[i + 1]
+            i += 2
+        else:
+            if arguments[i].startswith("-"):
+                options[arguments[i]] = True
+            else:
+                devicePath = arguments[i]
+            i += 1
+
+    if devicePath not in fleet["drives"]:
+        sys.stdout.write("Smartctl open device: " + str(devicePath) + " failed: No such device\n")
+        return EXIT_OPEN_FAILED
+    drive = SimulatedDrive(fleetDir, fleet, devicePath)
+    settings = drive.settings
+
+    # Inject latency, hangs and failures.
+    time.sleep(settings["latencySecs"] + random.random() * settings["latencyJitterSecs"])
+    if random.random() < settings["hangRate"]:
+        time.sleep(settings["hangSecs"])
+    if random.random() < settings["failRate"]:
+        sys.stdout.write("Smartctl open device: " + devicePath + " failed: Input/output error\n")
+        return EXIT_OPEN_FAILED
+
+    drive.advance()
+    header = drive.capture[:drive.capture.index("===")]  # The smartctl version banner.
+    if drive.isSpunDown():
+        if options.get("-n") in ["standby", "sleep"]:
+            sys.stdout.write(header + "Device is in STANDBY mode, exit(2)\n")
+            return EXIT_STANDBY
+        time.sleep(settings.get("spinUpSecs", 0.0))
+    drive.touch()
+    if "-t" in options:
+        sys.stdout.write(drive.startTest(options["-t"]))
+    elif "-X" in options:
+        sys.stdout.write(header + drive.abortTest())
+    else:
+        sys.stdout.write(drive.allInformation())
+    return EXIT_OK
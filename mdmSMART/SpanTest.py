@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+# Self-testing a drive in spans. A long self-test of a multi-terabyte drive runs for hours and starts over from
+#   nothing if it's interrupted. Instead, the drive's LBAs are split into SPAN_COUNT consecutive spans, each tested
+#   with a selective self-test ("smartctl -t select,FIRST-LAST"). The result of every span is kept in a file per
+#   serial number, so an interrupted run carries on from the first span that hasn't passed, and a run can stop at
+#   the first span that fails. The results are shown as a coverage map, one character per span.
+import json
+import os
+import re
+
+SPAN_DIR = "/var/tmp/mdm/spans"  # Where span results are kept, one file per serial number.
+SPAN_COUNT = 50  # Spans a drive is split into (and the width of its coverage map).
+
+# Possible results of a span.
+SPAN_PASSED, SPAN_FAILED = "passed", "failed"
+
+# Coverage map characters by span result (None: not tested yet).
+COVERAGE_CHARS = {SPAN_PASSED: "#", SPAN_FAILED: "X", None: "."}
+
+
+# First and last LBA of a span.
+def spanRange(lbaCount, index, spanCount=SPAN_COUNT):
+    return lbaCount * index // spanCount, lbaCount * (index + 1) // spanCount - 1
+
+
+def spanPath(serial, directory=SPAN_DIR):
+    return os.path.join(directory, re.sub(r"[^\w.-]", "_", serial) + ".json")
+
+
+# The span results of one drive.
+class SpanRecord(object):
+    def __init__(self, serial, lbaCount, directory=SPAN_DIR):
+        self.path = spanPath(serial, directory)
+        self.lbaCount = lbaCount
+        self.results = dict()  # Results by span index.
+        self.load()
+
+    # Read the saved results, unless they were for a drive of another size (eg, a reused serial number).
+    def load(self):
+        try:
+            with open(self.path) as spanFile:
+                saved = json.load(spanFile)
+            if saved["lbaCount"] == self.lbaCount and saved["spanCount"] == SPAN_COUNT:
+                self.results = dict((int(index), result) for index, result in saved["results"].items())
+        except (IOError, ValueError, KeyError):
+            self.results = dict()
+
+    # Save the results atomically, so a reader never sees a half-written file.
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        temporaryPath = self.path + ".tmp"
+        with open(temporaryPath, 'w') as spanFile:
+            json.dump({"lbaCount": self.lbaCount, "spanCount": SPAN_COUNT, "results": self.results}, spanFile)
+        os.rename(temporaryPath, self.path)
+
+    def setResult(self, index, result):
+        self.results[index] = result
+        self.save()
+
+    # Index of the first span that hasn't passed, or None if they all have.
+    def nextSpan(self):
+        for index in range(SPAN_COUNT):
+            if self.results.get(index) != SPAN_PASSED:
+                return index
+        return None
+
+    def passedCount(self):
+        return sum(1 for result in self.results.values() if result == SPAN_PASSED)
+
+    # Coverage map with a character per span, eg "####X.....".
+    def coverageMap(self):
+        return ''.join(COVERAGE_CHARS[self.results.get(index)] for index in range(SPAN_COUNT))
+
+
+coverageCache = dict()  # Modification time and coverage line of each span file read, by path.
+
+
+# A line describing a drive's span test coverage, or "" if it has no span results. Files are only read again
+#   when they change.
+def coverageLine(serial, lbaCount):
+    path = spanPath(serial)
+    try:
+        modified = os.stat(path).st_mtime
+    except OSError:
+        return ""
+    cached = coverageCache.get(path)
+    if cached is None or cached[0] != modified or cached[1] != lbaCount:
+        record = SpanRecord(serial, lbaCount)
+        line = ""
+        if len(record.results) > 0:
+            line = "Span coverage [%s] %d/%d spans passed" % (record.coverageMap(), record.passedCount(), SPAN_COUNT)
+        cached = coverageCache[path] = (modified, lbaCount, line)
+    return cached[2]
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+# Central supervision of child processes (smartctl queries, test commands, beeps, bulk I/O helpers).
+#   Every child gets an optional deadline and is killed if it overruns it. Killed and superseded children are kept
+#   on a list and polled until they can be reaped, so a child stuck in uninterruptible I/O never blocks the
+#   program and never becomes a zombie. Children started under the same key (eg, a drive's device path) are
+#   deduplicated: asking again for a command that is already running returns the running one.
+import os
+import signal
+import subprocess
+import time
+
+# Open the null device for dumping unwanted output into.
+DEVNULL = open(os.devnull, 'w')
+
+# Possible states of a supervised process.
+PROC_RUNNING, PROC_DONE, PROC_TIMED_OUT, PROC_CANCELLED = range(4)
+
+WAIT_POLL_INTERVAL_SECS = 0.01  # Polling interval of blocking waits.
+
+
+class SupervisedProcess(object):
+    def __init__(self, command, key=None, timeoutSecs=None, captureOutput=True):
+        self.command = command.split() if isinstance(command, basestring) else list(command)
+        self.key = key
+        self.startTime = time.time()
+        self.endTime = None
+        self.deadline = self.startTime + timeoutSecs if timeoutSecs else None
+        self.status = PROC_RUNNING
+        self.returnCode = None
+        self.output = ""
+        self.process = subprocess.Popen(self.command, stdout=subprocess.PIPE if captureOutput else DEVNULL,
+                                        stderr=DEVNULL)
+
+    # Check on the process, enforcing its deadline. Returns one of the PROC_ codes.
+    def poll(self):
+        if self.status != PROC_RUNNING:
+            return self.status
+        returnCode = self.process.poll()
+        if returnCode is not None:
+            if self.process.stdout is not None:
+                self.output, _ = self.process.communicate()
+            self.returnCode = returnCode
+            self.status = PROC_DONE
+            self.endTime = time.time()
+        elif self.deadline is not None and time.time() > self.deadline:
+            self.kill(PROC_TIMED_OUT)
+        return self.status
+
+    # Block until the process finishes or overruns its deadline. Returns one of the PROC_ codes.
+    def wait(self):
+        while self.poll() == PROC_RUNNING:
+            time.sleep(WAIT_POLL_INTERVAL_SECS)
+        return self.status
+
+    # Seconds the process ran for (so far, if it's still running).
+    def runTime(self):
+        return (self.endTime or time.time()) - self.startTime
+
+    # Kill the process without waiting for it to exit; the supervisor reaps it later.
+    def kill(self, status=PROC_CANCELLED):
+        if self.status == PROC_RUNNING:
+            try:
+                self.process.send_signal(signal.SIGKILL)
+            except OSError:
+                pass  # Already gone.
+            if self.process.stdout is not None:
+                self.process.stdout.close()  # Nobody will read the output, so don't hold the pipe open.
+            self.status = status
+            self.endTime = time.time()
+            supervisor.dying.append(self)
+
+    # Test whether a killed process has exited (and reap it if so).
+    def isReaped(self):
+        try:
+            return self.process.poll() is not None
+        except OSError:
+            return True
+
+
+class ProcessSupervisor(object):
+    def __init__(self):
+        self.keyed = dict()  # Most recent process started under each key.
+        self.anonymous = list()  # Fire-and-forget processes that only need reaping.
+        self.dying = list()  # Killed processes that haven't been reaped yet.
+
+    # Start a command. A keyed command that is already running under that key is returned instead of started
+    #   again, unless reuse is False (its output may predate something the caller has just changed); any other
+    #   process still running under the key is superseded (killed).
+    def spawn(self, command, key=None, timeoutSecs=None, captureOutput=True, reuse=True):
+        if key is not None:
+            existing = self.keyed.get(key)
+            if existing is not None and existing.poll() == PROC_RUNNING:
+                commandList = command.split() if isinstance(command, basestring) else list(command)
+                if reuse and existing.command == commandList:
+                    return existing
+                existing.kill()
+        process = SupervisedProcess(command, key, timeoutSecs, captureOutput)
+        if key is not None:
+            self.keyed[key] = process
+        else:
+            self.anonymous.append(process)
+        return process
+
+    # Run a command to completion (or its deadline) and return its output ("" if it didn't finish).
+    def run(self, command, timeoutSecs=None, key=None):
+        process = self.spawn(command, key, timeoutSecs)
+        if process.wait() == PROC_DONE:
+            return process.output
+        return ""
+
+    # Stop a process early.
+    def stop(self, process):
+        process.kill(PROC_CANCELLED)
+
+    # Enforce deadlines and reap finished or killed processes. Call this regularly from the main loop.
+    def reap(self):
+        for process in self.keyed.values():
+            process.poll()
+        self.anonymous = [process for process in self.anonymous if process.poll() == PROC_RUNNING]
+        self.dying = [process for process in self.dying if not process.isReaped()]
+
+    # Number of child processes that still hold a process slot.
+    def processCount(self):
+        running = [p for p in self.keyed.values() + self.anonymous if p.status == PROC_RUNNING]
+        return len(running) + len(self.dying)
+
+
+# The supervisor shared by everything in the program.
+supervisor = ProcessSupervisor()
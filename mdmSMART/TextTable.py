@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+# Fixed-width text table formatting for terminal (non-curses) output.
+#   Cells are plain text with an optional color code wrapped around them after padding, so the visible width of
+#   every cell is known from how it was built and never has to be measured by stripping escape codes.
+import sys
+
+
+# Pad or cut a plain-text cell to its column width plus a one-space separator, then wrap it in a color code.
+def formatCell(text, width, color=None, reset=""):
+    if len(text) <= width:
+        cell = text + ' ' * (width - len(text) + 1)
+    else:
+        cell = text[:width - 3] + "... "
+    if color:
+        return color + cell + reset
+    return cell
+
+
+class TextTable(object):
+    def __init__(self, columnWidths, reset=""):
+        self.columnWidths = columnWidths
+        self.reset = reset  # Code that ends a colored cell (restores the default text color).
+        self.width = sum(columnWidths) + len(columnWidths) - 1  # Visible width of a row without trailing space.
+
+    # Build a whole row in one join. Colors is an optional list of color codes, one per cell (None for plain).
+    def formatRow(self, cells, colors=None):
+        if colors is None:
+            return ''.join([formatCell(cells[i], self.columnWidths[i]) for i in range(len(cells))])
+        return ''.join([formatCell(cells[i], self.columnWidths[i], colors[i], self.reset)
+                        for i in range(len(cells))])
+
+    # A horizontal rule as wide as the table.
+    def ruleLine(self):
+        return '-' * self.width
+
+
+# Write a list of lines to the terminal with a single buffered write.
+def writeScreen(lines):
+    sys.stdout.write('\n'.join(lines) + '\n')
+    sys.stdout.flush()
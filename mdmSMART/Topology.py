@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+
+# Discovery of the shared link (host controller, USB hub or SAS expander) that a drive sits behind, so that
+#   bandwidth-heavy work can be spread across links instead of saturating one of them.
+import os
+import re
+
+# Kinds of shared link a drive can be attached through.
+BUS_CONTROLLER, BUS_USB_HUB, BUS_EXPANDER, BUS_UNKNOWN = range(4)
+
+# Maximum number of bandwidth-heavy jobs (wipes, verifies, ..) that may run at once behind one link of each kind.
+BUS_LIMITS = dict()
+BUS_LIMITS[BUS_CONTROLLER] = 4
+BUS_LIMITS[BUS_USB_HUB] = 1
+BUS_LIMITS[BUS_EXPANDER] = 2
+BUS_LIMITS[BUS_UNKNOWN] = 1
+
+# Patterns for components of a sysfs device path.
+PCI_ADDRESS = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-9a-f]$")
+USB_ROOT_HUB = re.compile(r"^usb[0-9]+$")
+USB_DEVICE = re.compile(r"^[0-9]+-[0-9.]+$")  # For example 2-1 (port 1 of bus 2) or 2-1.3 (port 3 of hub 2-1).
+SAS_EXPANDER = re.compile(r"^expander-[0-9]+:[0-9]+$")
+
+
+# Return (busType, busKey) identifying the shared link a block device is attached through.
+def busOf(devicePath):
+    sysfsPath = os.path.join("/sys/block", os.path.basename(devicePath))
+    if not os.path.exists(sysfsPath):
+        return BUS_UNKNOWN, devicePath  # Unknown devices get a link of their own.
+    return busOfSysfsPath(os.path.realpath(sysfsPath))
+
+
+# Interpret a resolved sysfs device path such as
+#   /sys/devices/pci0000:00/0000:00:14.0/usb2/2-1/2-1.3/2-1.3:1.0/host6/target6:0:0/6:0:0:0/block/sdf
+def busOfSysfsPath(sysfsPath):
+    components = sysfsPath.split('/')
+
+    # USB drives share the bandwidth of the hub their bridge is plugged into (or of the root hub).
+    usbDevices = [c for c in components if USB_DEVICE.match(c)]
+    if len(usbDevices) > 0:
+        if len(usbDevices) >= 2:
+            return BUS_USB_HUB, "usb:" + usbDevices[-2]
+        rootHubs = [c for c in components if USB_ROOT_HUB.match(c)]
+        return BUS_USB_HUB, "usb:" + (rootHubs[-1] if len(rootHubs) > 0 else usbDevices[-1])
+
+    # SAS drives share the bandwidth of the nearest expander.
+    expanders = [c for c in components if SAS_EXPANDER.match(c)]
+    if len(expanders) > 0:
+        return BUS_EXPANDER, "sas:" + expanders[-1]
+
+    # Everything else shares the host controller (the last PCI device on the path).
+    pciDevices = [c for c in components if PCI_ADDRESS.match(c)]
+    if len(pciDevices) > 0:
+        return BUS_CONTROLLER, "pci:" + pciDevices[-1]
+
+    return BUS_UNKNOWN, sysfsPath
@@ -1,11 +1,13 @@
 #!/usr/bin/env python
 
 # A collection of utility functions and classes for MDM (Multi-Drive Manager)
+import glob
 import os
 import re
-import subprocess
 import curses
 
+from Supervisor import supervisor
+
 # Open the null device for dumping unwanted output into.
 DEVNULL = open(os.devnull, 'w')
 
@@ -24,6 +26,16 @@ CEC_MAGENTA = CEC + "5"
 CEC_CYAN = CEC + "6"
 CEC_REVERSE = CEC + "r"
 
+# Whole-disk block device names: SCSI/SATA disks (sda .. sdzzz) and NVMe namespaces (nvme0n1). Partitions such
+#   as sda1 and nvme0n1p1 deliberately don't match.
+SCSI_DISK_NAME = re.compile(r"^sd[a-z]{1,3}$")
+NVME_DISK_NAME = re.compile(r"^nvme[0-9]+n[0-9]+$")
+
+# Environment variable that can hold a space-separated list of device paths to use instead of scanning.
+DEVICE_PATHS_VARIABLE = "MDM_DEVICE_PATHS"
+
+DEFAULT_COMMAND_TIMEOUT_SECS = 60  # Longest a blocking terminal command may run before it's killed.
+
 utilsWindow = None
 
 
@@ -132,22 +144,10 @@ def firstMatchPosition(searchString, text):
         return searchResult.start()
 
 
-def leftColumn(someString, width):
-    # Strip ANSI codes before calculating string length.
-    length = len(re.sub(r'\x1b\[([0-9,A-Z]{1,2}(;[0-9]{1,2})?(;[0-9]{3})?)?[m|K]?', '', someString))
-
-    # Left justify string, truncate (with ellipsis) or pad with spaces to fill column width.
-    if length <= width:
-        # NOTE: str.ljust() mis-formats this under some circumstances so don't use it.
-        return someString + ' ' * (width - length + 1)
-    else:
-        return someString[:width-3] + "... "
-
-
-# Get the output from a terminal command and block any error messages from appearing.
-def terminalCommand(command):
-    output, _ = subprocess.Popen(command.split(), stdout=subprocess.PIPE, stderr=DEVNULL).communicate()
-    return output
+# Get the output from a terminal command and block any error messages from appearing. A command that overruns
+#   its timeout is killed and gives no output.
+def terminalCommand(command, timeoutSecs=DEFAULT_COMMAND_TIMEOUT_SECS):
+    return supervisor.run(command, timeoutSecs)
 
 
 # Use a regular expression to capture part of a string.
@@ -157,3 +157,47 @@ def capture(pattern, text):
         return result.group(1)
     else:
         return CAPTURE_FAILED
+
+
+# First whole number in a string (such as a raw attribute value), or None.
+def firstNumber(text):
+    number = capture(r"([0-9]+)", str(text))
+    return int(number) if number is not CAPTURE_FAILED else None
+
+
+# A time span as a short string, eg "2h 5m", "5m" or "30s".
+def durationString(seconds):
+    seconds = int(seconds)
+    hours, minutes = seconds // 3600, seconds // 60 % 60
+    if hours != 0:
+        return str(hours) + "h " + str(minutes) + "m"
+    elif minutes != 0:
+        return str(minutes) + "m"
+    else:
+        return str(seconds) + "s"
+
+
+# A transfer rate as a short string, eg "85MB/s".
+def rateString(bytesPerSec):
+    return str(int(bytesPerSec / 1000000)) + "MB/s"
+
+
+# Return the device paths of all whole-disk block devices, ordered the way the kernel names them (sdz before sdaa).
+def findDrivePaths(includeNVMe=False):
+    # An explicit device list (eg, the virtual drives of the smartsim simulator) replaces scanning.
+    if DEVICE_PATHS_VARIABLE in os.environ:
+        return os.environ[DEVICE_PATHS_VARIABLE].split()
+
+    # Prefer the kernel's list of block devices and fall back on globbing /dev.
+    if os.path.isdir("/sys/block"):
+        names = os.listdir("/sys/block")
+    else:
+        names = [os.path.basename(path) for path in glob.glob("/dev/sd*") + glob.glob("/dev/nvme*")]
+
+    names = [name for name in names if SCSI_DISK_NAME.match(name) or (includeNVMe and NVME_DISK_NAME.match(name))]
+    return ["/dev/" + name for name in sorted(names, key=driveNameSortKey)]
+
+
+# Sort key that puts SCSI disks before NVMe ones and shorter names (sdz) before longer ones (sdaa).
+def driveNameSortKey(name):
+    return 0 if name.startswith("sd") else 1, len(name), name